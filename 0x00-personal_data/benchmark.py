@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of filtered_logger and encrypt_password.
+
+filter compares filter_datum with the field-by-field re.sub loop it
+replaced, on messages of several sizes:
+    ./benchmark.py --target filter --fields 5,20,100
+logging compares the records/sec of get_logger in its synchronous
+mode and in its asynchronous mode with each overflow policy:
+    ./benchmark.py --target logging --records 100000
+structured compares log_row, redacted per key by
+RedactingFormatter.format_structured, with the f-string message
+redacted by filter_datum that it replaced, and log_row as JSON lines:
+    ./benchmark.py --target structured --records 100000
+hash times hash_passwords on process and thread pools of several
+sizes:
+    ./benchmark.py --target hash --workers 1,2,4,8 --rounds 10
+"""
+from typing import Callable, List
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+from encrypt_password import hash_passwords, is_valid
+from filtered_logger import (OVERFLOW_POLICIES, PII_FIELDS,
+                             RedactingFormatter, filter_datum, format_row,
+                             get_logger, log_row)
+
+
+def legacy_filter_datum(fields: List[str], redaction: str, message: str,
+                        separator: str) -> str:
+    """
+    filter_datum as it was: one re.sub per field.
+    """
+    for field in fields:
+        message = re.sub(f"{field}=[^{separator}]*",
+                         f"{field}={redaction}", message)
+    return message
+
+
+def rate(func: Callable[[], object], seconds: float) -> float:
+    """
+    Calls func for about seconds seconds, returns the calls per second.
+    """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def bench_filter(field_counts: List[int], seconds: float) -> None:
+    """
+    Prints the calls per second of both filter_datum versions for
+    each number of redacted fields. Messages hold as many other
+    fields as redacted ones.
+    """
+    for count in field_counts:
+        fields = [f"pii{i}" for i in range(count)]
+        message = "".join(f"pii{i}=secret{i};other{i}=value{i};"
+                          for i in range(count))
+        expected = legacy_filter_datum(fields, "***", message, ";")
+        if filter_datum(fields, "***", message, ";") != expected:
+            raise AssertionError(f"outputs differ for {count} fields")
+
+        legacy = rate(lambda: legacy_filter_datum(
+            fields, "***", message, ";"), seconds)
+        single = rate(lambda: filter_datum(
+            fields, "***", message, ";"), seconds)
+        print(f"{count} fields: legacy {legacy:.0f}/s, "
+              f"single pass {single:.0f}/s, x{single / legacy:.1f}")
+
+
+def bench_logging(records: int, queue_size: int) -> None:
+    """
+    Prints the records per second of get_logger, writing to
+    /dev/null. For the asynchronous modes, caller is the rate seen by
+    the logging thread and total includes draining the queue.
+    """
+    message = ("name=Bob; email=bob@dylan.com; phone=555-0100; "
+               "ssn=000-00-0000; password=bobbycool; ip=10.0.0.1;")
+    modes = [("sync", {})] + [
+        (f"async {overflow}", {"asynchronous": True,
+                               "queue_size": queue_size,
+                               "overflow": overflow})
+        for overflow in OVERFLOW_POLICIES]
+    stderr = sys.stderr
+    with open(os.devnull, "w") as devnull:
+        for name, options in modes:
+            # The handlers bind sys.stderr when they are created
+            sys.stderr = devnull
+            try:
+                logger = get_logger(**options)
+            finally:
+                sys.stderr = stderr
+            handler = logger.handlers[-1]
+
+            start = time.perf_counter()
+            for _ in range(records):
+                logger.info(message)
+            caller = time.perf_counter() - start
+            logger.removeHandler(handler)
+            handler.close()
+            total = time.perf_counter() - start
+
+            dropped = getattr(handler, "dropped", 0)
+            print(f"{name}: caller {records / caller:.0f}/s, "
+                  f"total {records / total:.0f}/s, dropped {dropped}")
+
+
+def rate_of(func: Callable[[], object], count: int) -> float:
+    """
+    Calls func count times, returns the calls per second.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def bench_structured(records: int) -> None:
+    """
+    Prints the records per second of a users row logged as an
+    f-string message then redacted by regex, and logged with log_row
+    as text and as JSON lines, through a RedactingFormatter writing
+    to /dev/null.
+    """
+    row = {"name": "Bob", "email": "bob@dylan.com", "phone": "555-0100",
+           "ssn": "000-00-0000", "password": "bobbycool",
+           "ip": "10.0.0.1", "last_login": "2019-11-14 06:16:24",
+           "user_agent": "Mozilla/5.0"}
+    formatter = RedactingFormatter(PII_FIELDS)
+    record = logging.makeLogRecord({"name": "user_data",
+                                    "msg": format_row(row)})
+    structured = logging.makeLogRecord(dict(
+        record.__dict__, msg="users row", row=row))
+    if formatter.format(record) != formatter.format(structured):
+        raise AssertionError("text outputs differ")
+
+    logger = logging.getLogger("benchmark_structured")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    with open(os.devnull, "w") as devnull:
+        handler = logging.StreamHandler(devnull)
+        logger.addHandler(handler)
+        try:
+            handler.setFormatter(RedactingFormatter(PII_FIELDS))
+            string = rate_of(lambda: logger.info(format_row(row)), records)
+            keyed = rate_of(lambda: log_row(logger, row), records)
+            handler.setFormatter(RedactingFormatter(PII_FIELDS, True))
+            json_lines = rate_of(lambda: log_row(logger, row), records)
+            print(f"string then regex {string:.0f}/s, structured text "
+                  f"{keyed:.0f}/s (x{keyed / string:.1f}), structured "
+                  f"JSON lines {json_lines:.0f}/s")
+        finally:
+            logger.removeHandler(handler)
+
+
+def bench_hash(worker_counts: List[int], passwords: int,
+               rounds: int) -> None:
+    """
+    Prints the hashes per second of hash_passwords for each pool
+    kind and size, with the speedup over a single worker.
+    """
+    plain = [f"password{i}" for i in range(passwords)]
+    for threads in (False, True):
+        kind = "threads" if threads else "processes"
+        base = None
+        for workers in worker_counts:
+            start = time.perf_counter()
+            hashes = list(hash_passwords(plain, workers, rounds, threads))
+            elapsed = time.perf_counter() - start
+            if not is_valid(hashes[-1], plain[-1]):
+                raise AssertionError("hashes out of order")
+            per_second = passwords / elapsed
+            base = base or per_second
+            print(f"{kind}, {workers} workers: {per_second:.1f}/s, "
+                  f"x{per_second / base:.1f}")
+
+
+def main() -> None:
+    """
+    Runs the selected benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--target",
+                        choices=("filter", "logging", "structured", "hash"),
+                        default="filter")
+    parser.add_argument("--seconds", type=float, default=1.0,
+                        help="time spent on each measurement")
+    parser.add_argument("--fields", default="5,20,100",
+                        help="comma-separated numbers of redacted fields")
+    parser.add_argument("--records", type=int, default=100000,
+                        help="records logged by each logging mode or path")
+    parser.add_argument("--queue-size", type=int, default=10000,
+                        help="queue size of the asynchronous modes")
+    parser.add_argument("--workers", default="1,2,4",
+                        help="comma-separated pool sizes")
+    parser.add_argument("--passwords", type=int, default=64,
+                        help="passwords hashed by each pool")
+    parser.add_argument("--rounds", type=int, default=10,
+                        help="bcrypt cost of the hashes")
+    args = parser.parse_args()
+
+    if args.target == "filter":
+        bench_filter([int(count) for count in args.fields.split(",")],
+                     args.seconds)
+    elif args.target == "logging":
+        bench_logging(args.records, args.queue_size)
+    elif args.target == "structured":
+        bench_structured(args.records)
+    elif args.target == "hash":
+        bench_hash([int(count) for count in args.workers.split(",")],
+                   args.passwords, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,69 @@
 Hash a password string using bcrypt and return
 the salted, hashed password.
 """
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+import os
+import time
 import bcrypt
 
 
-def hash_password(password: str) -> bytes:
+def calibrate_rounds(budget_ms: float = 250, min_rounds: int = 12,
+                     max_rounds: int = 16) -> int:
+    """
+    Return the highest bcrypt cost whose hash time fits in
+    budget_ms on this machine.
+    """
+    rounds = min_rounds
+    while rounds < max_rounds:
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # Each extra round doubles the work
+        if elapsed_ms * 2 > budget_ms:
+            break
+        rounds += 1
+    return rounds
+
+
+@lru_cache(maxsize=None)
+def target_rounds() -> int:
+    """
+    Return the bcrypt cost for new hashes, calibrated once against
+    PERSONAL_DATA_HASH_BUDGET_MS (250 ms by default) and never below
+    PERSONAL_DATA_HASH_MIN_ROUNDS (12, the bcrypt default).
+    """
+    budget_ms = float(os.getenv("PERSONAL_DATA_HASH_BUDGET_MS", "250"))
+    min_rounds = int(os.getenv("PERSONAL_DATA_HASH_MIN_ROUNDS", "12"))
+    return calibrate_rounds(budget_ms, min_rounds)
+
+
+def hash_rounds(hashed_password: bytes) -> int:
+    """
+    Return the bcrypt cost stored in a hashed password.
+    """
+    return int(hashed_password.split(b"$")[2])
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Check if a hashed password was made with a lower cost
+    than the calibrated one.
+    """
+    return hash_rounds(hashed_password) < target_rounds()
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> bytes:
     """
     Hash a password string using bcrypt and return
     the salted, hashed password.
     """
-    # Generate a salt
-    salt = bcrypt.gensalt()
+    # Generate a salt, with the calibrated cost unless one is given
+    if rounds is None:
+        rounds = target_rounds()
+    salt = bcrypt.gensalt(rounds)
 
     # Hash the password with the salt
     hashed = bcrypt.hashpw(password.encode(), salt)
@@ -27,3 +80,63 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     # Use bcrypt to compare the provided password with the hashed password
     isValid = bcrypt.checkpw(password.encode(), hashed_password)
     return isValid
+
+
+def _is_valid_pair(pair: Tuple[bytes, str]) -> bool:
+    """
+    Check a (hashed_password, password) pair.
+    """
+    return is_valid(*pair)
+
+
+def _ordered_map(func: Callable, items: Iterable, workers: Optional[int],
+                 threads: bool) -> Iterator:
+    """
+    Apply func to items on a pool, yielding results in input order.
+
+    At most twice as many tasks as workers are in flight, so items
+    is consumed lazily and results stream as they complete.
+    """
+    workers = workers or os.cpu_count() or 1
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor_class(workers) as executor:
+        limit = 2 * workers
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= limit:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def hash_passwords(passwords: Iterable[str], workers: Optional[int] = None,
+                   rounds: Optional[int] = None,
+                   threads: bool = False) -> Iterator[bytes]:
+    """
+    Hash many passwords in parallel, yielding the hashes in the
+    order of passwords.
+
+    Work runs on a process pool of workers processes (default: one
+    per CPU) with the calibrated cost unless rounds is given. bcrypt
+    releases the GIL while hashing, so threads=True uses a thread
+    pool instead and avoids pickling the passwords.
+    """
+    if rounds is None:
+        rounds = target_rounds()
+    return _ordered_map(partial(hash_password, rounds=rounds), passwords,
+                        workers, threads)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]],
+                workers: Optional[int] = None,
+                threads: bool = False) -> Iterator[bool]:
+    """
+    Check many (hashed_password, password) pairs in parallel,
+    yielding the results in the order of pairs.
+    """
+    return _ordered_map(_is_valid_pair, pairs, workers, threads)
@@ -5,13 +5,60 @@ using regex substitution.
 """
 
 import re
-from typing import List
+from collections import deque
+from functools import lru_cache
+from typing import (Any, Callable, Dict, Iterator, List, Match, Optional,
+                    Pattern, Sequence, Tuple)
+import argparse
+import copy
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import sys
+import time
 import mysql.connector
 from mysql.connector import connection
 
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+OVERFLOW_POLICIES = ("block", "drop_oldest", "count")
+
+
+@lru_cache(maxsize=128)
+def _redaction_pattern(
+    fields: Tuple[str, ...], separator: str
+) -> Optional[Pattern]:
+    """
+    Compiles all fields into a single alternation pattern.
+
+    Returns None when a field is not a plain literal name, in which
+    case a single pass could disagree with the field-by-field loop.
+    """
+    if not fields or len(separator) != 1:
+        return None
+    for field in fields:
+        if not field or "=" in field or separator in field:
+            return None
+        if re.escape(field) != field:
+            return None
+    return re.compile("({})=[^{}]*".format("|".join(fields), separator))
+
+
+def _single_pass_pattern(
+    fields: List[str], redaction: str, separator: str
+) -> Optional[Pattern]:
+    """
+    Returns the compiled alternation for fields, or None when the
+    redaction itself could create new matches for a later field.
+    """
+    pattern = _redaction_pattern(tuple(fields), separator)
+    if pattern is None or "\\" in redaction or "=" in redaction:
+        return None
+    if separator in redaction:
+        return None
+    return pattern
 
 
 def filter_datum(
@@ -21,12 +68,35 @@ def filter_datum(
     Obfuscates specified fields in a log message
     using regex substitution.
     """
+    pattern = _single_pass_pattern(fields, redaction, separator)
+    if pattern is not None:
+        return pattern.sub(lambda m: m.group(1) + "=" + redaction, message)
+
     for field in fields:
         message = re.sub(f"{field}=[^{separator}]*",
                          f"{field}={redaction}", message)
     return message
 
 
+def redact_row(
+    row: Dict[str, Any], fields: List[str], redaction: str
+) -> Dict[str, Any]:
+    """
+    Returns a copy of row with the values of fields replaced
+    by redaction.
+    """
+    redacted = dict(row)
+    for field in fields:
+        if field in redacted:
+            redacted[field] = redaction
+    return redacted
+
+
+def format_row(row: Dict[str, Any]) -> str:
+    """Formats a row as a `key=value; ` log message"""
+    return "; ".join(f"{key}={value}" for key, value in row.items()) + ";"
+
+
 class RedactingFormatter(logging.Formatter):
     """Redacting Formatter class"""
 
@@ -34,26 +104,184 @@ class RedactingFormatter(logging.Formatter):
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], json_lines: bool = False):
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.json_lines = json_lines
+        self._pattern = _single_pass_pattern(
+            fields, self.REDACTION, self.SEPARATOR
+        )
+        # Only the message can hold a match when it closes the format
+        # and nothing before it may contain '='
+        self._message_only = (
+            self._pattern is not None
+            and self._fmt.endswith("%(message)s")
+            and "=" not in self._fmt
+        )
+        self._time_cache = (None, None)
+
+    def _redact(self, text: str) -> str:
+        """Obfuscates the configured fields in text"""
+        if self._pattern is None:
+            return filter_datum(
+                self.fields, self.REDACTION, text, self.SEPARATOR
+            )
+        return self._pattern.sub(self._replace, text)
+
+    def _replace(self, match: Match) -> str:
+        """Replacement for a single field match"""
+        return match.group(1) + "=" + self.REDACTION
+
+    def formatTime(self, record: logging.LogRecord,
+                   datefmt: Optional[str] = None) -> str:
+        """Formats the record time, reusing the text of the same second"""
+        if datefmt:
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        cached_second, text = self._time_cache
+        if cached_second != second:
+            text = time.strftime(self.default_time_format,
+                                 self.converter(record.created))
+            self._time_cache = (second, text)
+        if self.default_msec_format:
+            text = self.default_msec_format % (text, record.msecs)
+        return text
+
+    def format_structured(self, record: logging.LogRecord) -> str:
+        """
+        Redacts the row attached to record key by key and serializes
+        it once, as the text format or as a JSON line.
+        """
+        row = redact_row(record.row, self.fields, self.REDACTION)
+        if self.json_lines:
+            return json.dumps({
+                "time": self.formatTime(record, self.datefmt),
+                "level": record.levelname,
+                "logger": record.name,
+                "row": row,
+            }, default=str)
+
+        record.message = format_row(row)
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        return self.formatMessage(record)
 
     def format(self, record: logging.LogRecord) -> str:
         """Filters values in incoming log records"""
-        original_message = super().format(record)
-        return filter_datum(
-            self.fields, self.REDACTION, original_message, self.SEPARATOR
-        )
+        if isinstance(getattr(record, "row", None), dict):
+            return self.format_structured(record)
+        if (not self._message_only or record.exc_info or record.exc_text
+                or record.stack_info or "=" in record.name
+                or "=" in record.levelname):
+            return self._redact(super().format(record))
+
+        record.message = self._redact(record.getMessage())
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        return self.formatMessage(record)
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    """QueueListener that waits for room to enqueue its stop sentinel"""
+
+    def enqueue_sentinel(self) -> None:
+        """Blocks until the sentinel fits, so queued records are flushed"""
+        self.queue.put(self._sentinel)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler for a bounded queue, leaving redaction and formatting
+    to the listener thread.
+
+    overflow decides what happens when the queue is full:
+    "block" waits for room, "drop_oldest" discards the oldest queued
+    record and "count" discards the new one. Discarded records are
+    counted in dropped, under the handler lock.
+    """
+
+    def __init__(self, record_queue: queue.Queue, overflow: str = "block"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        super(BoundedQueueHandler, self).__init__(record_queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self.listener = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Merges args into the message without formatting the record"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Enqueues a record according to the overflow policy"""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            # self.lock is reentrant, handle() may already hold it
+            with self.lock:
+                self.dropped += 1
+            if self.overflow == "count":
+                return
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def close(self) -> None:
+        """Stops the listener after it has written every queued record"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super(BoundedQueueHandler, self).close()
 
 
-def get_logger() -> logging.Logger:
-    """Returns a Logger object"""
+def log_row(logger: logging.Logger, row: Dict[str, Any],
+            level: int = logging.INFO) -> None:
+    """
+    Logs row as structured data: a RedactingFormatter redacts it per
+    key instead of re-parsing a message string. Other formatters only
+    see a message without any row value.
+    """
+    logger.log(level, "users row", extra={"row": row})
+
+
+def get_logger(asynchronous: bool = False, queue_size: int = 10000,
+               overflow: str = "block",
+               json_lines: bool = False) -> logging.Logger:
+    """
+    Returns a Logger object.
+
+    With asynchronous set, records go through a bounded queue and are
+    redacted and written by a background listener thread. The listener
+    is stopped and drained when the handler is closed, which
+    logging.shutdown does at interpreter exit.
+    """
 
     logger = logging.getLogger("user_date")
     logger.setLevel(logging.INFO)
     logger.propagate = False
     handler = logging.StreamHandler()
-    handler.setFormatter(RedactingFormatter(PII_FIELDS))
+    handler.setFormatter(RedactingFormatter(PII_FIELDS, json_lines))
+
+    if asynchronous:
+        queue_handler = BoundedQueueHandler(queue.Queue(queue_size), overflow)
+        queue_handler.listener = _FlushingQueueListener(
+            queue_handler.queue, handler, respect_handler_level=True
+        )
+        queue_handler.listener.start()
+        handler = queue_handler
+
     logger.addHandler(handler)
 
     return logger
@@ -73,25 +301,203 @@ def get_db() -> connection.MySQLConnection:
     )
 
 
-def main():
+def streaming_cursor(db: Any) -> Any:
     """
-    Retrieves all rows in the users table and logs each row
-    with filtered PII data.
+    Returns a cursor that reads rows from the server as they are
+    fetched instead of buffering the whole result set.
     """
-    logger = get_logger()
-    db = get_db()
+    try:
+        return db.cursor(buffered=False)
+    except TypeError:
+        # DB-API connections without the option (sqlite3) already stream
+        return db.cursor()
+
+
+def iter_rows(cursor: Any, batch_size: int = 1000
+              ) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the rows of an executed query as column name to value
+    dictionaries, fetching batch_size rows at a time.
+    """
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield dict(zip(columns, row))
+
+
+def export_users(db: Any, logger: logging.Logger,
+                 batch_size: int = 1000) -> int:
+    """
+    Streams every row of the users table to logger and returns
+    the number of rows logged.
+    """
+    count = 0
+    cursor = streaming_cursor(db)
+    try:
+        cursor.execute("SELECT * FROM users;")
+        for row in iter_rows(cursor, batch_size):
+            log_row(logger, row)
+            count += 1
+    finally:
+        cursor.close()
+    return count
+
+
+def key_ranges(db: Any, key: str, shards: int,
+               max_span: Optional[int] = None) -> List[Tuple[int, int]]:
+    """
+    Splits the users table into at least shards half-open ranges
+    [start, end) of its integer key column, none wider than max_span
+    keys when given.
+    """
+    if not key.isidentifier():
+        raise ValueError(f"Invalid key column: {key}")
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM users;")
+    try:
+        cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM users;")
+        low, high = cursor.fetchone()
+    finally:
+        cursor.close()
+    if low is None:
+        return []
+    low, high = int(low), int(high)
+    step = max(1, -(-(high - low + 1) // shards))
+    if max_span is not None:
+        step = min(step, max(1, max_span))
+    return [(start, min(start + step, high + 1))
+            for start in range(low, high + 1, step)]
 
-    for row in cursor:
-        message = (
-            f"name={row[0]}; email={row[1]}; phone={row[2]}; ssn={row[3]}; "
-            f"password={row[4]}; ip={row[5]}; last_login={row[6]};user_agent={row[7]}"
+
+def _export_shard(task: Tuple) -> Any:
+    """
+    Worker side of export_users_parallel: fetches and redacts one key
+    range. When the shard goes to its own file, lines are written as
+    rows arrive and the number of rows is returned. Otherwise the
+    formatted lines are returned, the key range bounds how many.
+    """
+    (connect, key, (start, end), index,
+     batch_size, output_dir, json_lines) = task
+    formatter = RedactingFormatter(PII_FIELDS, json_lines)
+    db = connect()
+    cursor = streaming_cursor(db)
+    lines = []
+    count = 0
+    out = None
+    if output_dir is not None:
+        out = open(os.path.join(output_dir,
+                                "users-{:04d}.log".format(index)), "w")
+    try:
+        cursor.execute(
+            f"SELECT * FROM users WHERE {key} >= {int(start)} "
+            f"AND {key} < {int(end)} ORDER BY {key};"
         )
-        logger.info(message)
+        for row in iter_rows(cursor, batch_size):
+            record = logging.LogRecord("user_date", logging.INFO, __file__,
+                                       0, "users row", None, None)
+            record.row = row
+            line = formatter.format(record)
+            count += 1
+            if out is None:
+                lines.append(line)
+            else:
+                out.write(line + "\n")
+    finally:
+        cursor.close()
+        db.close()
+        if out is not None:
+            out.close()
+
+    return lines if out is None else count
+
+
+def export_users_parallel(connect: Callable[[], Any], workers: int,
+                          key: str = "id", batch_size: int = 1000,
+                          output_dir: Optional[str] = None,
+                          json_lines: bool = False,
+                          shard_keys: int = 10000) -> int:
+    """
+    Exports the users table with workers processes, each one fetching
+    and redacting its own ranges of the key column. connect must be
+    picklable, every worker opens its own connection with it.
+
+    Lines are written to stderr in key order, or to one file per
+    shard in output_dir. A shard spans at most shard_keys keys and at
+    most twice as many shards as workers are in flight, so memory
+    stays flat however large the table. Returns the number of rows
+    exported.
+    """
+    db = connect()
+    try:
+        ranges = key_ranges(db, key, workers * 4, shard_keys)
+    finally:
+        db.close()
+
+    count = 0
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for index, key_range in enumerate(ranges):
+            pending.append(pool.apply_async(
+                _export_shard, ((connect, key, key_range, index, batch_size,
+                                 output_dir, json_lines),)))
+            if len(pending) >= 2 * workers:
+                count += _write_shard(pending.popleft().get())
+        while pending:
+            count += _write_shard(pending.popleft().get())
+    sys.stderr.flush()
+    return count
+
+
+def _write_shard(result: Any) -> int:
+    """
+    Writes the lines returned by _export_shard to stderr, returns the
+    number of rows of the shard.
+    """
+    if isinstance(result, int):
+        return result
+    for line in result:
+        sys.stderr.write(line + "\n")
+    return len(result)
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    """
+    Retrieves all rows in the users table and logs each row
+    with filtered PII data.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of export processes")
+    parser.add_argument("--batch-size", type=int,
+                        default=int(os.getenv("PERSONAL_DATA_BATCH_SIZE",
+                                              "1000")),
+                        help="rows fetched per round trip")
+    parser.add_argument("--key",
+                        default=os.getenv("PERSONAL_DATA_KEY_COLUMN", "id"),
+                        help="integer column used to partition the table")
+    parser.add_argument("--output-dir",
+                        help="with --workers, write one file per shard")
+    parser.add_argument("--shard-keys", type=int, default=10000,
+                        help="with --workers, key values per shard")
+    parser.add_argument("--json", action="store_true",
+                        help="write JSON lines instead of the text format")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1:
+        export_users_parallel(get_db, args.workers, args.key,
+                              args.batch_size, args.output_dir, args.json,
+                              args.shard_keys)
+        return
+
+    logger = get_logger(json_lines=args.json)
+    db = get_db()
 
-    cursor.close()
-    db.close()
+    try:
+        export_users(db, logger, args.batch_size)
+    finally:
+        db.close()
 
 
 if __name__ == "__main__":
@@ -9,11 +9,14 @@ from flask_cors import (CORS, cross_origin)
 import os
 from api.v1.auth.auth import Auth
 from api.v1.auth.basic_auth import BasicAuth
+from api.v1.auth.path_matcher import PathMatcher
 
 app = Flask(__name__)
 app.register_blueprint(app_views)
 CORS(app, resources={r"/api/v1/*": {"origins": "*"}})
 auth = None
+excluded_paths = PathMatcher(['/api/v1/status/', '/api/v1/unauthorized/',
+                              '/api/v1/forbidden/'])
 
 auth_type = os.getenv('AUTH_TYPE', 'auth')
 if auth_type == 'Auth':
@@ -49,9 +52,6 @@ def forbidden(error) -> str:
 def before_request():
     """Filter and validate each request before processing."""
     if auth:
-        excluded_paths = ['/api/v1/status/', '/api/v1/unauthorized/',
-                          '/api/v1/forbidden/']
-
         if auth.require_auth(request.path, excluded_paths):
             if auth.authorization_header(request) is None:
                 abort(401)
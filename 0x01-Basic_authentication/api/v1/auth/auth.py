@@ -3,14 +3,28 @@
 auth class
 """
 from flask import request
-from typing import List, TypeVar
+from functools import lru_cache
+from typing import List, Tuple, TypeVar, Union
+from .path_matcher import PathMatcher
+
+
+@lru_cache(maxsize=32)
+def _compile(excluded_paths: Tuple[str, ...]) -> PathMatcher:
+    """Compiles a list of excluded paths once."""
+    return PathMatcher(excluded_paths)
 
 
 class Auth:
     """Auth class template for managing API authentication."""
 
-    def require_auth(self, path: str, excluded_paths: List[str]) -> bool:
-        """Returns False, indicating that no authentication is required."""
+    def require_auth(self, path: str,
+                     excluded_paths: Union[List[str], PathMatcher]) -> bool:
+        """
+        Returns False if path is one of excluded_paths, or starts with
+        the prefix of an excluded path ending with `*`.
+
+        excluded_paths can be compiled beforehand into a PathMatcher.
+        """
 
         if path is None:
             return True
@@ -21,11 +35,10 @@ class Auth:
         if not path.endswith('/'):
             path = path + '/'
 
-        for excluded_path in excluded_paths:
-            if path == excluded_path:
-                return False
+        if not isinstance(excluded_paths, PathMatcher):
+            excluded_paths = _compile(tuple(excluded_paths))
 
-        return True
+        return not excluded_paths.matches(path)
 
     def authorization_header(self, request=None) -> str:
         """Returns None - to be implemented later."""
@@ -3,14 +3,51 @@
 BasicAuth Class that inherits from Auth
 """
 from .auth import Auth
+from .credential_cache import CredentialCache
 import base64
+import os
+import time
+import binascii
+import weakref
 from models.user import User
 from typing import TypeVar
 
+# Longer headers are rejected before decoding anything
+MAX_AUTHORIZATION_HEADER_LENGTH = int(
+    os.getenv("BASIC_AUTH_MAX_HEADER_LENGTH", "4096"))
+
+# Credential caches of the live BasicAuth instances
+_CACHES = weakref.WeakSet()
+
+
+def _invalidate_caches(user: TypeVar('User')):
+    """
+    Forgets the headers of a user that was saved or removed, in the
+    cache of every live BasicAuth instance.
+    """
+    for cache in list(_CACHES):
+        cache.invalidate(user.id)
+
+
+User.on_change(_invalidate_caches)
+
 
 class BasicAuth(Auth):
     """BasicAuth class that inherits from Auth"""
 
+    def __init__(self):
+        """
+        Initializes the cache of resolved Authorization headers,
+        emptied for a user each time it is saved or removed. The cache
+        is only held weakly by the listener, so it goes away with the
+        instance.
+        """
+        self.credential_cache = CredentialCache(
+            int(os.getenv("BASIC_AUTH_CACHE_SIZE", "1024")),
+            float(os.getenv("BASIC_AUTH_CACHE_TTL", "60")),
+        )
+        _CACHES.add(self.credential_cache)
+
     def extract_base64_authorization_header(self, authorization_header: str
                                             ) -> str:
         """
@@ -61,6 +98,38 @@ class BasicAuth(Auth):
         email, password = decoded_base64_authorization_header.split(':', 1)
         return email, password
 
+    def parse_authorization_header(self, authorization_header: str
+                                   ) -> (str, str):
+        """
+        Extracts the user email and password from a Basic
+        Authorization header in one pass.
+
+        Same result as chaining extract_base64_authorization_header,
+        decode_base64_authorization_header and extract_user_credentials,
+        without the intermediate strings.
+        """
+        if not isinstance(authorization_header, str):
+            return None, None
+        if len(authorization_header) > MAX_AUTHORIZATION_HEADER_LENGTH:
+            return None, None
+        if not authorization_header.startswith("Basic "):
+            return None, None
+
+        try:
+            decoded = base64.b64decode(authorization_header[6:],
+                                       validate=True)
+        except (binascii.Error, ValueError):
+            return None, None
+        email, colon, password = decoded.partition(b":")
+        if not colon:
+            return None, None
+        # ':' never occurs inside a multi-byte UTF-8 sequence, so both
+        # parts decode exactly when the whole value does
+        try:
+            return email.decode("utf-8"), password.decode("utf-8")
+        except UnicodeDecodeError:
+            return None, None
+
     def user_object_from_credentials(self, user_email: str, user_pwd: str
                                      ) -> TypeVar('User'):
         """
@@ -80,6 +149,11 @@ class BasicAuth(Auth):
         if not user.is_valid_password(user_pwd):
             return None
 
+        # Upgrade legacy or outdated hashes while the password is known
+        if user.password_needs_rehash():
+            user.password = user_pwd
+            user.save()
+
         return user
 
     def current_user(self, request=None) -> TypeVar("User"):
@@ -87,31 +161,35 @@ class BasicAuth(Auth):
         Retrieves the User instance for a request using
         Basic Authentication.
         """
+        start = time.perf_counter()
         # Get the Authorization header from the request
         authorization_header = self.authorization_header(request)
         if authorization_header is None:
             return None
-
-        # Extract the Base64 part of the Authorization header
-        base64_authorization = self.extract_base64_authorization_header(
-            authorization_header
-        )
-        if base64_authorization is None:
-            return None
-
-        # Decode the Base64 part of the Authorization header
-        decoded_authorization = self.decode_base64_authorization_header(
-            base64_authorization
-        )
-        if decoded_authorization is None:
+        # Before the cache, which would hash the whole header
+        if len(authorization_header) > MAX_AUTHORIZATION_HEADER_LENGTH:
             return None
 
-        # Extract user credentials from the decoded Authorization header
-        user_email, user_pwd = self.extract_user_credentials(
-            decoded_authorization)
+        # Reuse the user this exact header resolved to before
+        user_id = self.credential_cache.get(authorization_header)
+        if user_id is not None:
+            user = User.get(user_id)
+            if user is not None:
+                self.credential_cache.record(
+                    True, time.perf_counter() - start)
+                return user
+        generation = self.credential_cache.generation()
+
+        # Extract user credentials from the Authorization header
+        user_email, user_pwd = self.parse_authorization_header(
+            authorization_header)
         if user_email is None or user_pwd is None:
             return None
 
         # Retrieve the User object from the credentials
         user = self.user_object_from_credentials(user_email, user_pwd)
+        if user is not None:
+            self.credential_cache.put(authorization_header, user.id,
+                                      generation)
+        self.credential_cache.record(False, time.perf_counter() - start)
         return user
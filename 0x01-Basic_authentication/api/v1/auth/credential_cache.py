@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+CredentialCache class
+"""
+from collections import OrderedDict
+from typing import Optional
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+
+class CredentialCache:
+    """
+    Bounded LRU cache from an Authorization header to the ID of the
+    user it authenticated, with a time to live.
+
+    Headers are stored as an HMAC under a per-process random key, so
+    the cache never holds credentials.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        """Initializes an empty cache."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._hit_seconds = 0.0
+        self._miss_seconds = 0.0
+
+    def _digest(self, authorization_header: str) -> bytes:
+        """Returns the keyed hash of a header."""
+        return hmac.new(self._key, authorization_header.encode("utf-8"),
+                        hashlib.sha256).digest()
+
+    def generation(self) -> int:
+        """
+        Returns a token to pass to put, so that an entry resolved
+        before an invalidation isn't cached after it.
+        """
+        return self._generation
+
+    def get(self, authorization_header: str) -> Optional[str]:
+        """Returns the cached user ID of a header, or None."""
+        digest = self._digest(authorization_header)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            user_id, expires_at = entry
+            if expires_at < time.monotonic():
+                self._discard(digest)
+                return None
+            self._entries.move_to_end(digest)
+            return user_id
+
+    def put(self, authorization_header: str, user_id: str,
+            generation: int) -> None:
+        """Caches the user ID a header was resolved to."""
+        digest = self._digest(authorization_header)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._discard(digest)
+            self._entries[digest] = (user_id, time.monotonic() + self.ttl)
+            self._by_user.setdefault(user_id, set()).add(digest)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, user_id: str) -> None:
+        """Drops every entry of a user."""
+        with self._lock:
+            self._generation += 1
+            for digest in list(self._by_user.get(user_id, ())):
+                self._discard(digest)
+                self.invalidations += 1
+
+    def _discard(self, digest: bytes) -> None:
+        """Removes one entry, the lock must be held."""
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return
+        digests = self._by_user.get(entry[0])
+        digests.discard(digest)
+        if not digests:
+            del self._by_user[entry[0]]
+
+    def record(self, hit: bool, seconds: float) -> None:
+        """Counts a lookup and how long the request took to resolve."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self._hit_seconds += seconds
+            else:
+                self.misses += 1
+                self._miss_seconds += seconds
+
+    def stats(self) -> dict:
+        """Returns the hit rate and average latencies in milliseconds."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "hit_ms": (self._hit_seconds * 1000 / self.hits
+                           if self.hits else 0.0),
+                "miss_ms": (self._miss_seconds * 1000 / self.misses
+                            if self.misses else 0.0),
+            }
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+PathMatcher class
+"""
+from typing import Iterable
+
+_END = ""
+
+
+class PathMatcher:
+    """
+    Set of paths compiled once: exact paths are kept in a set and
+    paths ending with `*` in a prefix trie, so a lookup costs
+    O(length of the path) whatever the number of paths.
+    """
+
+    def __init__(self, paths: Iterable[str]):
+        """Compiles paths."""
+        self.paths = list(paths)
+        self._exact = set()
+        self._trie = {}
+        for path in self.paths:
+            if not path.endswith("*"):
+                self._exact.add(path)
+                continue
+            node = self._trie
+            for char in path[:-1]:
+                node = node.setdefault(char, {})
+            node[_END] = {}
+
+    def __len__(self) -> int:
+        """Returns the number of paths."""
+        return len(self.paths)
+
+    def matches(self, path: str) -> bool:
+        """Returns True if path is one of the paths or starts with
+        the prefix of one of the wildcards."""
+        if path in self._exact:
+            return True
+        node = self._trie
+        if not node:
+            return False
+        for char in path:
+            if _END in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return _END in node
@@ -2,18 +2,62 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request
 from models.user import User
+import json
+
+STREAM_PAGE_SIZE = 1000
 
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters:
+      - limit (optional): maximum number of User objects
+      - after (optional): ID of the last User of the previous page
+      - format (optional): ndjson to stream one User object per line
     Return:
-      - list of all User objects JSON represented
+      - list of all User objects JSON represented, ordered by ID when
+        paginated, with a Link header to the next page
+      - 400 if limit isn't a positive integer
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return jsonify({'error': "Wrong limit"}), 400
+
+    if request.args.get('format') == 'ndjson':
+        def generate(after: str, limit: int):
+            """ Yield one JSON line per User, a page at a time """
+            while limit is None or limit > 0:
+                size = STREAM_PAGE_SIZE
+                if limit is not None:
+                    size = min(size, limit)
+                    limit -= size
+                users = User.page(after, size)
+                for user in users:
+                    yield json.dumps(user.to_json()) + "\n"
+                if len(users) < size:
+                    return
+                after = users[-1].id
+        return Response(generate(after, limit),
+                        mimetype='application/x-ndjson')
+
+    if limit is None and after is None:
+        all_users = [user.to_json() for user in User.all()]
+        return jsonify(all_users)
+
+    users = User.page(after, limit)
+    response = jsonify([user.to_json() for user in users])
+    if limit is not None and len(users) == limit:
+        response.headers['Link'] = '<{}?limit={}&after={}>; rel="next"'.format(
+            request.base_url, limit, users[-1].id)
+    return response
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
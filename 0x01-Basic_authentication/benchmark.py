@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+""" Microbenchmarks of the models and the authentication classes
+
+Run from this directory, nothing is read from or written to the
+.db_*.json files:
+    python3 benchmark.py --target index --sizes 1000,10000,100000
+index times User.search by email through the unique email index
+against the linear scan it replaced.
+    python3 benchmark.py --target paths --paths 10,50,200
+paths times Auth.require_auth with a compiled PathMatcher against
+the loop over excluded paths it replaced.
+    python3 benchmark.py --target parse
+parse times BasicAuth.parse_authorization_header against the three
+extract/decode steps it fused, and the rejection of a header over
+MAX_AUTHORIZATION_HEADER_LENGTH.
+    python3 benchmark.py --target memory --users 100000
+memory measures with tracemalloc the memory of slotted User objects
+and of the same attributes kept in a per-instance __dict__, as
+before __slots__, scaled to 1M users.
+"""
+from datetime import datetime
+from itertools import cycle
+from typing import Callable, List
+import argparse
+import base64
+import gc
+import random
+import time
+import tracemalloc
+import uuid
+
+from api.v1.auth.auth import Auth
+from api.v1.auth.basic_auth import MAX_AUTHORIZATION_HEADER_LENGTH
+from api.v1.auth.basic_auth import BasicAuth
+from api.v1.auth.path_matcher import PathMatcher
+from models.base import DATA
+from models.user import User
+
+
+def rate(func: Callable[[], object], seconds: float) -> float:
+    """ Calls of func per second, measured for about seconds seconds
+    """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def scan_search(attributes: dict) -> List[User]:
+    """ User.search as it was: a filter over every user
+    """
+    return [user for user in DATA['User'].values()
+            if all(getattr(user, k) == v for k, v in attributes.items())]
+
+
+def bench_index(sizes: List[int], seconds: float):
+    """ Print the latency of a search by email, with and without the
+    index, for tables of each size
+    """
+    saved = DATA.get('User')
+    try:
+        for size in sizes:
+            DATA['User'] = {}
+            for i in range(size):
+                user = User(email="user{}@example.com".format(i))
+                DATA['User'][user.id] = user
+            User._build_indexes()
+            emails = ["user{}@example.com".format(random.randrange(size))
+                      for _ in range(1000)]
+            email = cycle(emails)
+
+            scan = rate(lambda: scan_search({'email': next(email)}), seconds)
+            index = rate(lambda: User.search({'email': next(email)}), seconds)
+            print("{} users: scan {:.3f} ms, index {:.4f} ms".format(
+                size, 1000 / scan, 1000 / index))
+    finally:
+        if saved is None:
+            DATA.pop('User', None)
+        else:
+            DATA['User'] = saved
+        User._build_indexes()
+
+
+def loop_require_auth(path: str, excluded_paths: List[str]) -> bool:
+    """ Auth.require_auth as it was: a loop over excluded_paths
+    """
+    if path is None:
+        return True
+    if excluded_paths is None or not excluded_paths:
+        return True
+    if not path.endswith('/'):
+        path = path + '/'
+    for excluded_path in excluded_paths:
+        if path == excluded_path:
+            return False
+    return True
+
+
+def bench_paths(counts: List[int], seconds: float):
+    """ Print the require_auth calls per second of the loop and of
+    PathMatcher for each number of excluded paths, half of the
+    requested paths being excluded. wildcards is PathMatcher with as
+    many prefix wildcards added, which the loop can't express
+    """
+    auth = Auth()
+    for count in counts:
+        excluded = ["/api/v1/excluded{}/".format(i) for i in range(count)]
+        matcher = PathMatcher(excluded)
+        wildcards = PathMatcher(excluded + ["/api/v1/stat{}*".format(i)
+                                            for i in range(count)])
+        paths = cycle(["/api/v1/excluded{}".format(i) for i in range(count)]
+                      + ["/api/v1/users/{}".format(i) for i in range(count)])
+
+        loop = rate(lambda: loop_require_auth(next(paths), excluded),
+                    seconds)
+        compiled = rate(lambda: auth.require_auth(next(paths), matcher),
+                        seconds)
+        wild = rate(lambda: auth.require_auth(next(paths), wildcards),
+                    seconds)
+        print("{} paths: loop {:.0f}/s, matcher {:.0f}/s, x{:.1f}, "
+              "wildcards {:.0f}/s".format(count, loop, compiled,
+                                          compiled / loop, wild))
+
+
+def bench_parse(seconds: float):
+    """ Print the parses per second of the chained steps and of
+    parse_authorization_header
+    """
+    auth = BasicAuth()
+    header = "Basic " + base64.b64encode(
+        "bob@hbtn.io:H0lbertonSchool98!".encode()).decode()
+    oversized = "Basic " + "A" * MAX_AUTHORIZATION_HEADER_LENGTH
+
+    def chained(value: str):
+        """ The three steps current_user used to chain
+        """
+        return auth.extract_user_credentials(
+            auth.decode_base64_authorization_header(
+                auth.extract_base64_authorization_header(value)))
+
+    if chained(header) != auth.parse_authorization_header(header):
+        raise AssertionError("parsers disagree")
+    steps = rate(lambda: chained(header), seconds)
+    fused = rate(lambda: auth.parse_authorization_header(header), seconds)
+    rejected = rate(lambda: auth.parse_authorization_header(oversized),
+                    seconds)
+    print("steps {:.0f}/s, fused {:.0f}/s, x{:.1f}".format(
+        steps, fused, fused / steps))
+    print("oversized header rejected: {:.0f}/s".format(rejected))
+
+
+class DictUser():
+    """ A user as it was before __slots__: attributes in __dict__
+    """
+
+    def __init__(self, **kwargs: dict):
+        """ Keep every keyword argument as an attribute
+        """
+        self.__dict__.update(kwargs)
+
+
+def user_fields(i: int) -> dict:
+    """ Attributes of the i-th user, new objects for every call
+    """
+    now = datetime.utcnow()
+    return {'id': str(uuid.uuid4()), 'created_at': now,
+            'updated_at': now.replace(),
+            'email': "user{}@example.com".format(i),
+            '_password': "scrypt$16384$8$1${}$".format(uuid.uuid4().hex),
+            'first_name': "First{}".format(i),
+            'last_name': "Last{}".format(i)}
+
+
+def bench_memory(users: int):
+    """ Print the memory per 1M users of slotted and __dict__ users,
+    attribute values included
+    """
+    def slotted(fields: dict) -> User:
+        """ A User built with fields, the way load_from_file does
+        """
+        user = User(email=fields['email'], _password=fields['_password'],
+                    first_name=fields['first_name'],
+                    last_name=fields['last_name'])
+        user.id = fields['id']
+        user.created_at = fields['created_at']
+        user.updated_at = fields['updated_at']
+        return user
+
+    results = {}
+    for name, build in (("__dict__", lambda fields: DictUser(**fields)),
+                        ("slots", slotted)):
+        gc.collect()
+        tracemalloc.start()
+        objs = {}
+        for i in range(users):
+            obj = build(user_fields(i))
+            objs[obj.id] = obj
+        results[name], _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del objs
+    per_million = 1000000 / users / 1024 / 1024
+    print("per 1M users: __dict__ {:.0f} MB, slots {:.0f} MB".format(
+        results["__dict__"] * per_million, results["slots"] * per_million))
+
+
+def main():
+    """ Run the selected benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target",
+                        choices=("index", "paths", "parse", "memory"),
+                        default="index")
+    parser.add_argument("--seconds", type=float, default=1.0,
+                        help="time spent on each measurement")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma-separated numbers of users")
+    parser.add_argument("--paths", default="10,50,200",
+                        help="comma-separated numbers of excluded paths")
+    parser.add_argument("--users", type=int, default=100000,
+                        help="users built by the memory benchmark")
+    args = parser.parse_args()
+
+    if args.target == "index":
+        bench_index([int(size) for size in args.sizes.split(",")],
+                    args.seconds)
+    elif args.target == "paths":
+        bench_paths([int(count) for count in args.paths.split(",")],
+                    args.seconds)
+    elif args.target == "parse":
+        bench_parse(args.seconds)
+    elif args.target == "memory":
+        bench_memory(args.users)
+
+
+if __name__ == "__main__":
+    main()
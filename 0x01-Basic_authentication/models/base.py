@@ -1,21 +1,297 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from typing import Callable, TypeVar, List, Iterable, Iterator
+from os import getenv, path
+from models.journal import Journal
+from models.snapshot import Snapshot, write_snapshot
+import atexit
+import bisect
 import json
+import os
+import tempfile
+import threading
+import time
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+INDEXES = {}
+JOURNALS = {}
+ORDERS = {}
+LISTENERS = {}
+LOCKS = {}
+
+# 'file' rewrites .db_<class>.json on every change, 'journal' appends
+# changes to .db_<class>.journal and compacts it in the background
+STORE_MODE = getenv('BASE_STORE_MODE', 'file')
+JOURNAL_FSYNC = getenv('BASE_JOURNAL_FSYNC', 'always')
+JOURNAL_BATCH_SIZE = int(getenv('BASE_JOURNAL_BATCH_SIZE', '100'))
+JOURNAL_INTERVAL = float(getenv('BASE_JOURNAL_INTERVAL', '1.0'))
+JOURNAL_MAX_BYTES = int(getenv('BASE_JOURNAL_MAX_BYTES', '16777216'))
+# 'json' keeps snapshots in .db_<class>.json, 'binary' in a memory
+# mapped .db_<class>.snap whose objects are only parsed when used
+SNAPSHOT_FORMAT = getenv('BASE_SNAPSHOT_FORMAT', 'json')
+# In file mode, saves landing within this many milliseconds of each
+# other are written together (0 writes every save on its own)
+GROUP_COMMIT_MS = float(getenv('BASE_GROUP_COMMIT_MS', '0'))
+
+GROUP_COMMITS = {}
+_compaction_lock = threading.Lock()
+_batch = threading.local()
+_UNLOADED = object()
+
+
+def _write_file(file_path: str, snapshot, obsolete: str = None,
+                sync: bool = True):
+    """ Atomically replace file_path by snapshot, then remove obsolete
+
+    snapshot comes from Base._snapshot: a JSON dictionary, or the
+    records and indexed attributes of a binary snapshot.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=path.basename(file_path),
+                                    dir=path.dirname(file_path) or '.')
+    binary = file_path.endswith('.snap')
+    try:
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            if binary:
+                write_snapshot(f, *snapshot)
+            else:
+                json.dump(snapshot, f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if obsolete is not None:
+        os.remove(obsolete)
+
+
+class GroupCommit():
+    """ Merge the file writes of saves from concurrent threads
+
+    The first caller waits window seconds, then writes the file once
+    for everyone who called in the meantime.
+    """
+
+    def __init__(self, cls: type, window: float):
+        """ Initialize the group commit of a class
+        """
+        self.cls = cls
+        self.window = window
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._written = 0
+        self._leading = False
+
+    def commit(self):
+        """ Return once a write covering this call is done
+        """
+        with self._cond:
+            self._requested += 1
+            ticket = self._requested
+            while self._written < ticket:
+                if self._leading:
+                    self._cond.wait()
+                    continue
+                self._leading = True
+                self._cond.release()
+                try:
+                    time.sleep(self.window)
+                    # Every change counted so far is already in DATA
+                    covered = self._requested
+                    self.cls.save_to_file()
+                finally:
+                    self._cond.acquire()
+                    self._leading = False
+                    self._cond.notify_all()
+                self._written = max(self._written, covered)
+
+
+def _compact(cls: type, objs: dict, journal_path: str):
+    """ Write a snapshot of objs, a copy of the objects of cls that
+    covers a rotated journal, then drop the journal
+    """
+    try:
+        _write_file(cls._snapshot_path(), cls._snapshot(objs), journal_path)
+    finally:
+        _compaction_lock.release()
+
+
+@atexit.register
+def _close_journals():
+    """ Sync every open journal
+    """
+    for journal in JOURNALS.values():
+        journal.close()
+
+
+class LazyObjects(dict):
+    """ Objects of one class loaded from a binary snapshot
+
+    Every ID is present from the start, each object is only parsed
+    the first time it is read.
+    """
+
+    def __init__(self, cls: type, snapshot: Snapshot):
+        """ Initialize with every object of snapshot unloaded
+        """
+        super().__init__(dict.fromkeys(snapshot.ids, _UNLOADED))
+        self.cls = cls
+        self.snapshot = snapshot
+        self._lock = threading.Lock()
+
+    def _hydrate(self, obj_id: str, obj):
+        """ Return obj, parsing it first if it is still unloaded
+        """
+        if obj is not _UNLOADED:
+            return obj
+        with self._lock:
+            obj = dict.get(self, obj_id)
+            if obj is _UNLOADED:
+                obj = self.cls(**self.snapshot.read(obj_id))
+                dict.__setitem__(self, obj_id, obj)
+        return obj
+
+    def __getitem__(self, obj_id: str):
+        """ Object by ID
+        """
+        return self._hydrate(obj_id, dict.__getitem__(self, obj_id))
+
+    def get(self, obj_id: str, default=None):
+        """ Object by ID, or default
+        """
+        return self._hydrate(obj_id, dict.get(self, obj_id, default))
+
+    def values(self) -> list:
+        """ All objects
+        """
+        objs = (self.get(obj_id) for obj_id in list(self))
+        return [obj for obj in objs if obj is not None]
+
+    def items(self) -> list:
+        """ All (ID, object) pairs
+        """
+        return [(obj.id, obj) for obj in self.values()]
+
+    def peek(self, obj_id: str, attribute: str):
+        """ Attribute of an object, without loading it when the
+        snapshot stores the value
+        """
+        obj = dict.get(self, obj_id)
+        if obj is _UNLOADED:
+            try:
+                return self.snapshot.index_value(obj_id, attribute)
+            except KeyError:
+                obj = self[obj_id]
+        return getattr(obj, attribute, None)
+
+    def copy(self) -> 'LazyObjects':
+        """ Shallow copy, objects still unloaded stay unloaded
+        """
+        objs = LazyObjects.__new__(LazyObjects)
+        dict.update(objs, dict.copy(self))
+        objs.cls = self.cls
+        objs.snapshot = self.snapshot
+        objs._lock = threading.Lock()
+        return objs
+
+
+def _peek(objs: dict, obj_id: str, attribute: str):
+    """ Attribute of an object of DATA, loading it only if needed
+    """
+    if isinstance(objs, LazyObjects):
+        return objs.peek(obj_id, attribute)
+    return getattr(objs[obj_id], attribute, None)
+
+
+class Index():
+    """ Hash index from one attribute value to object IDs
+    """
+
+    def __init__(self, attribute: str, unique: bool = False):
+        """ Initialize an empty index
+        """
+        self.attribute = attribute
+        self.unique = unique
+        self._ids = {}
+        self._values = {}
+        # Objects whose value can't be hashed always are candidates
+        self._unhashable = {}
+
+    def lookup(self, value) -> List[str]:
+        """ IDs of the objects that may have this value
+        """
+        try:
+            obj_ids = list(self._ids.get(value, ()))
+        except TypeError:
+            obj_ids = []
+        return obj_ids + list(self._unhashable)
+
+    def check(self, obj: TypeVar('Base')):
+        """ Raise ValueError if obj would break a unique index
+        """
+        if not self.unique:
+            return
+        value = getattr(obj, self.attribute, None)
+        if value is None:
+            return
+        try:
+            obj_ids = self._ids.get(value, ())
+        except TypeError:
+            return
+        for obj_id in obj_ids:
+            if obj_id != obj.id:
+                raise ValueError("{} {} already exists".format(
+                    self.attribute, value))
+
+    def add(self, obj: TypeVar('Base')):
+        """ Index obj under its current value
+        """
+        self.put(obj.id, getattr(obj, self.attribute, None))
+
+    def put(self, obj_id: str, value):
+        """ Index an object ID under value
+        """
+        self.discard(obj_id)
+        try:
+            self._ids.setdefault(value, {})[obj_id] = None
+        except TypeError:
+            self._unhashable[obj_id] = None
+            return
+        self._values[obj_id] = value
+
+    def discard(self, obj_id: str):
+        """ Remove an object ID from the index
+        """
+        self._unhashable.pop(obj_id, None)
+        if obj_id not in self._values:
+            return
+        value = self._values.pop(obj_id)
+        ids = self._ids[value]
+        del ids[obj_id]
+        if not ids:
+            del self._ids[value]
 
 
 class Base():
     """ Base class
     """
 
+    # Subclasses declare their own attributes in __slots__ too, so
+    # instances carry no per-object __dict__
+    __slots__ = ('id', 'created_at', 'updated_at')
+
+    # Indexed attribute -> unique flag, kept up to date by save/remove
+    indexes = {}
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -44,11 +320,34 @@ class Base():
             return False
         return (self.id == other.id)
 
+    @classmethod
+    def _attributes(cls) -> List[str]:
+        """ Slot attributes of the class, base classes first
+        """
+        attributes = cls.__dict__.get('_slot_attributes')
+        if attributes is None:
+            attributes = []
+            for klass in reversed(cls.__mro__):
+                slots = klass.__dict__.get('__slots__', ())
+                if isinstance(slots, str):
+                    slots = (slots,)
+                attributes.extend(s for s in slots if not s.startswith('__'))
+            cls._slot_attributes = attributes
+        return attributes
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
         result = {}
-        for key, value in self.__dict__.items():
+        items = []
+        for key in self.__class__._attributes():
+            try:
+                items.append((key, getattr(self, key)))
+            except AttributeError:
+                continue
+        # Subclasses without __slots__ still have a __dict__
+        items.extend(getattr(self, '__dict__', {}).items())
+        for key, value in items:
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
@@ -59,47 +358,248 @@ class Base():
 
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then replay the journal
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
+        file_path = cls._snapshot_path()
         DATA[s_class] = {}
-        if not path.exists(file_path):
+        # A snapshot in the other format is converted
+        other_path = cls._snapshot_path('binary' if SNAPSHOT_FORMAT != 'binary'
+                                        else 'json')
+        convert = not path.exists(file_path) and path.exists(other_path)
+        source_path = other_path if convert else file_path
+        if source_path.endswith('.snap') and path.exists(source_path):
+            DATA[s_class] = LazyObjects(cls, Snapshot(source_path))
+        elif path.exists(source_path):
+            with open(source_path, 'r') as f:
+                objs_json = json.load(f)
+                for obj_id, obj_json in objs_json.items():
+                    DATA[s_class][obj_id] = cls(**obj_json)
+
+        journal_paths = [cls._journal_path() + ".old", cls._journal_path()]
+        for journal_path in journal_paths:
+            for entry in Journal.replay(journal_path):
+                if entry['op'] == 'save':
+                    obj_json = entry['obj']
+                    DATA[s_class][obj_json['id']] = cls(**obj_json)
+                else:
+                    DATA[s_class].pop(entry['id'], None)
+        cls._build_indexes()
+        ORDERS.pop(s_class, None)
+
+        # Fold journals into the file so they are never replayed over
+        # newer changes: a compaction left unfinished in journal mode,
+        # every journal in file mode
+        if STORE_MODE == 'journal':
+            journal_paths = journal_paths[:1]
+        obsolete = [p for p in journal_paths if path.exists(p)]
+        if convert:
+            obsolete.append(other_path)
+        if obsolete:
+            _write_file(file_path, cls._snapshot())
+            for obsolete_path in obsolete:
+                os.remove(obsolete_path)
+
+    @classmethod
+    def _snapshot_path(cls, snapshot_format: str = None) -> str:
+        """ Path of the snapshot file of the class
+        """
+        if (snapshot_format or SNAPSHOT_FORMAT) == 'binary':
+            return ".db_{}.snap".format(cls.__name__)
+        return ".db_{}.json".format(cls.__name__)
+
+    @classmethod
+    def _snapshot(cls, objs: dict = None):
+        """ Copy of objs, all objects by default, ready for _write_file
+        in SNAPSHOT_FORMAT
+        """
+        if objs is None:
+            objs = DATA[cls.__name__]
+        if SNAPSHOT_FORMAT != 'binary':
+            return {obj_id: obj.to_json(True)
+                    for obj_id, obj in list(objs.items())}
+
+        attributes = list(cls.indexes)
+        records = []
+        for obj_id, obj in list(dict.items(objs)):
+            if obj is _UNLOADED:
+                # Copied as is, without parsing it
+                data = objs.snapshot.raw(obj_id)
+                values = {a: objs.peek(obj_id, a) for a in attributes}
+            else:
+                data = json.dumps(obj.to_json(True)).encode()
+                values = {a: getattr(obj, a, None) for a in attributes}
+            records.append((obj_id, data, values))
+        return records, attributes
+
+    @classmethod
+    def _journal_path(cls) -> str:
+        """ Path of the journal of the class
+        """
+        return ".db_{}.journal".format(cls.__name__)
+
+    @classmethod
+    def _journal(cls) -> Journal:
+        """ Journal of the class, opened on first use
+        """
+        s_class = cls.__name__
+        if JOURNALS.get(s_class) is None:
+            JOURNALS[s_class] = Journal(cls._journal_path(), JOURNAL_FSYNC,
+                                        JOURNAL_BATCH_SIZE, JOURNAL_INTERVAL)
+        return JOURNALS[s_class]
+
+    @classmethod
+    @contextmanager
+    def batch(cls) -> Iterator[None]:
+        """ Defer persistence of saves and removes until the block exits
+
+        Each class changed in the block is written once at the end,
+        even if the block raises, as the changes are already in memory.
+        Blocks can be nested, the outermost one writes.
+        """
+        if getattr(_batch, 'depth', 0) == 0:
+            _batch.dirty = {}
+        _batch.depth = getattr(_batch, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            _batch.depth -= 1
+            if _batch.depth == 0:
+                dirty, _batch.dirty = _batch.dirty, {}
+                for dirty_cls in dirty:
+                    if STORE_MODE == 'journal':
+                        dirty_cls._journal().sync()
+                    else:
+                        dirty_cls.save_to_file()
+
+    @classmethod
+    def _persist(cls, entry: dict):
+        """ Persist one change according to STORE_MODE
+        """
+        in_batch = getattr(_batch, 'depth', 0) > 0
+        if in_batch:
+            _batch.dirty[cls] = None
+
+        if STORE_MODE != 'journal':
+            if in_batch:
+                return
+            if GROUP_COMMIT_MS > 0:
+                cls._group_commit().commit()
+            else:
+                cls.save_to_file()
             return
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+        journal = cls._journal()
+        journal.append(entry, sync=not in_batch)
+        if journal.size() < JOURNAL_MAX_BYTES:
+            return
+        if not _compaction_lock.acquire(blocking=False):
+            return
+        try:
+            # Rotate first: any change missing from the copy below was
+            # appended after the rotation and stays in the new journal.
+            # Only the dictionary is copied here, the objects are
+            # serialized by the compaction thread
+            journal_path = journal.rotate()
+            threading.Thread(target=_compact,
+                             args=(cls, DATA[cls.__name__].copy(),
+                                   journal_path)).start()
+        except BaseException:
+            _compaction_lock.release()
+            raise
 
     @classmethod
-    def save_to_file(cls):
-        """ Save all objects to file
+    def _group_commit(cls) -> GroupCommit:
+        """ Group commit of the class, created on first use
+        """
+        s_class = cls.__name__
+        if GROUP_COMMITS.get(s_class) is None:
+            GROUP_COMMITS[s_class] = GroupCommit(cls, GROUP_COMMIT_MS / 1000)
+        return GROUP_COMMITS[s_class]
+
+    @classmethod
+    def _lock(cls) -> threading.RLock:
+        """ Lock of the class, held while its objects and indexes change
+        """
+        return LOCKS.setdefault(cls.__name__, threading.RLock())
+
+    @classmethod
+    def _indexes(cls) -> dict:
+        """ Indexes of the class, created on first use
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        if INDEXES.get(s_class) is None:
+            INDEXES[s_class] = {attribute: Index(attribute, unique)
+                                for attribute, unique in cls.indexes.items()}
+            objs = DATA.get(s_class, {})
+            for obj_id in list(objs):
+                for index in INDEXES[s_class].values():
+                    index.put(obj_id, _peek(objs, obj_id, index.attribute))
+        return INDEXES[s_class]
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def _build_indexes(cls):
+        """ Rebuild the indexes of the class from DATA
+        """
+        INDEXES.pop(cls.__name__, None)
+        cls._indexes()
+
+    @classmethod
+    def save_to_file(cls):
+        """ Save all objects to file
+        """
+        _write_file(cls._snapshot_path(), cls._snapshot(), sync=False)
 
     def save(self):
         """ Save current object
         """
         s_class = self.__class__.__name__
-        self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        # Two saves of the same unique value must not both pass check
+        with self.__class__._lock():
+            indexes = self.__class__._indexes().values()
+            for index in indexes:
+                index.check(self)
+            self.updated_at = datetime.utcnow()
+            is_new = self.id not in DATA[s_class]
+            DATA[s_class][self.id] = self
+            for index in indexes:
+                index.add(self)
+            if is_new and ORDERS.get(s_class) is not None:
+                bisect.insort(ORDERS[s_class], self.id)
+        self.__class__._notify(self)
+        self.__class__._persist({'op': 'save', 'obj': self.to_json(True)})
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
+        with self.__class__._lock():
+            if DATA[s_class].get(self.id) is None:
+                return
             del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+            for index in self.__class__._indexes().values():
+                index.discard(self.id)
+            ids = ORDERS.get(s_class)
+            if ids is not None:
+                position = bisect.bisect_left(ids, self.id)
+                if position < len(ids) and ids[position] == self.id:
+                    del ids[position]
+        self.__class__._notify(self)
+        self.__class__._persist({'op': 'remove', 'id': self.id})
+
+    @classmethod
+    def on_change(cls, callback: Callable[[TypeVar('Base')], None]):
+        """ Call callback with each object of the class that is saved
+        or removed
+        """
+        LISTENERS.setdefault(cls.__name__, []).append(callback)
+
+    @classmethod
+    def _notify(cls, obj: TypeVar('Base')):
+        """ Call the on_change callbacks of the class
+        """
+        for callback in LISTENERS.get(cls.__name__, ()):
+            callback(obj)
 
     @classmethod
     def count(cls) -> int:
@@ -114,6 +614,23 @@ class Base():
         """
         return cls.search()
 
+    @classmethod
+    def page(cls, after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Return up to limit objects ordered by ID, starting after
+        the ID after
+        """
+        s_class = cls.__name__
+        # A save between sorting and publishing would be missed
+        with cls._lock():
+            if ORDERS.get(s_class) is None:
+                ORDERS[s_class] = sorted(DATA[s_class])
+            ids = ORDERS[s_class]
+        start = 0 if after is None else bisect.bisect_right(ids, after)
+        end = len(ids) if limit is None else start + limit
+        objs = [DATA[s_class].get(obj_id) for obj_id in ids[start:end]]
+        return [obj for obj in objs if obj is not None]
+
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
@@ -133,5 +650,14 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
+
+        indexes = cls._indexes()
+        for k, v in attributes.items():
+            if k in indexes:
+                # An object removed since the lookup is skipped
+                objs = [DATA[s_class].get(obj_id)
+                        for obj_id in indexes[k].lookup(v)]
+                return list(filter(_search, [obj for obj in objs
+                                             if obj is not None]))
+
         return list(filter(_search, DATA[s_class].values()))
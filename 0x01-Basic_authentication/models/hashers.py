@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+""" Password hashers module
+
+Every stored password starts with the name of its hasher, like
+"scrypt$16384$8$1$<salt>$<hash>", so hashers can be swapped without
+breaking passwords already stored. Bare SHA256 hex digests are the
+legacy format and are only verified, never produced.
+"""
+from typing import Dict, List, Optional
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+
+HASHERS = {}
+
+
+def _b64encode(data: bytes) -> str:
+    """ Base64 without padding
+    """
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    """ Decode base64 without padding
+    """
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class Hasher():
+    """ Password hasher, stored passwords are "<name>$<encoded>"
+    """
+
+    name = None
+
+    def encode(self, pwd: str) -> str:
+        """ Hash a password
+        """
+        raise NotImplementedError
+
+    def verify(self, pwd: str, encoded: str) -> bool:
+        """ Check a password against one of its stored hashes
+        """
+        raise NotImplementedError
+
+    def must_update(self, encoded: str) -> bool:
+        """ Check if a stored hash was made with other parameters
+        """
+        return False
+
+
+class SHA256Hasher(Hasher):
+    """ Legacy unsalted SHA256, kept to verify old passwords
+    """
+
+    name = 'sha256'
+
+    def encode(self, pwd: str) -> str:
+        """ Hash a password, without prefix for legacy readers
+        """
+        return hashlib.sha256(pwd.encode()).hexdigest().lower()
+
+    def verify(self, pwd: str, encoded: str) -> bool:
+        """ Check a password against a SHA256 hex digest
+        """
+        return hmac.compare_digest(self.encode(pwd), encoded.lower())
+
+
+class ScryptHasher(Hasher):
+    """ scrypt from hashlib
+
+    Cost is set by USER_SCRYPT_N (16384), USER_SCRYPT_R (8) and
+    USER_SCRYPT_P (1).
+    """
+
+    name = 'scrypt'
+
+    def __init__(self):
+        """ Read the cost parameters
+        """
+        self.n = int(os.getenv("USER_SCRYPT_N", "16384"))
+        self.r = int(os.getenv("USER_SCRYPT_R", "8"))
+        self.p = int(os.getenv("USER_SCRYPT_P", "1"))
+
+    @staticmethod
+    def _derive(pwd: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        """ scrypt key of a password
+        """
+        # Memory used by OpenSSL, plus some room
+        maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+        return hashlib.scrypt(pwd.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=maxmem, dklen=32)
+
+    def encode(self, pwd: str) -> str:
+        """ Hash a password with a random salt
+        """
+        salt = os.urandom(16)
+        key = self._derive(pwd, salt, self.n, self.r, self.p)
+        return "{}${}${}${}${}${}".format(self.name, self.n, self.r, self.p,
+                                          _b64encode(salt), _b64encode(key))
+
+    def verify(self, pwd: str, encoded: str) -> bool:
+        """ Check a password with the parameters stored in its hash
+        """
+        try:
+            _, n, r, p, salt, key = encoded.split("$")
+            key = _b64decode(key)
+            actual = self._derive(pwd, _b64decode(salt),
+                                  int(n), int(r), int(p))
+        except ValueError:
+            return False
+        return hmac.compare_digest(actual, key)
+
+    def must_update(self, encoded: str) -> bool:
+        """ Check if the stored cost differs from the configured one
+        """
+        params = encoded.split("$")[1:4]
+        return params != [str(self.n), str(self.r), str(self.p)]
+
+
+class BcryptHasher(Hasher):
+    """ bcrypt, cost set by USER_BCRYPT_ROUNDS (12)
+    """
+
+    name = 'bcrypt'
+
+    def __init__(self):
+        """ Read the cost parameter
+        """
+        import bcrypt
+        self._bcrypt = bcrypt
+        self.rounds = int(os.getenv("USER_BCRYPT_ROUNDS", "12"))
+
+    def encode(self, pwd: str) -> str:
+        """ Hash a password with a random salt
+        """
+        salt = self._bcrypt.gensalt(self.rounds)
+        hashed = self._bcrypt.hashpw(pwd.encode(), salt)
+        return "{}${}".format(self.name, hashed.decode())
+
+    def verify(self, pwd: str, encoded: str) -> bool:
+        """ Check a password against a bcrypt hash
+        """
+        hashed = encoded[len(self.name) + 1:].encode()
+        try:
+            return self._bcrypt.checkpw(pwd.encode(), hashed)
+        except ValueError:
+            return False
+
+    def must_update(self, encoded: str) -> bool:
+        """ Check if the stored cost differs from the configured one
+        """
+        # bcrypt$$2b$12$...
+        return encoded.split("$")[3] != "{:02d}".format(self.rounds)
+
+
+class Argon2Hasher(Hasher):
+    """ Argon2id from argon2-cffi
+
+    Cost is set by USER_ARGON2_TIME_COST (3), USER_ARGON2_MEMORY_COST
+    (65536 KiB) and USER_ARGON2_PARALLELISM (4).
+    """
+
+    name = 'argon2'
+
+    def __init__(self):
+        """ Read the cost parameters
+        """
+        import argon2
+        self._exceptions = argon2.exceptions
+        self._hasher = argon2.PasswordHasher(
+            time_cost=int(os.getenv("USER_ARGON2_TIME_COST", "3")),
+            memory_cost=int(os.getenv("USER_ARGON2_MEMORY_COST", "65536")),
+            parallelism=int(os.getenv("USER_ARGON2_PARALLELISM", "4")))
+
+    def encode(self, pwd: str) -> str:
+        """ Hash a password with a random salt
+        """
+        return "{}${}".format(self.name, self._hasher.hash(pwd))
+
+    def verify(self, pwd: str, encoded: str) -> bool:
+        """ Check a password against an Argon2 hash
+        """
+        try:
+            return self._hasher.verify(encoded[len(self.name) + 1:], pwd)
+        except (self._exceptions.VerificationError,
+                self._exceptions.InvalidHash):
+            return False
+
+    def must_update(self, encoded: str) -> bool:
+        """ Check if the stored cost differs from the configured one
+        """
+        return self._hasher.check_needs_rehash(encoded[len(self.name) + 1:])
+
+
+def register(hasher: Hasher):
+    """ Make a hasher available under its name
+    """
+    HASHERS[hasher.name] = hasher
+
+
+def available() -> List[str]:
+    """ Names of the registered hashers
+    """
+    return list(HASHERS)
+
+
+def get_hasher(name: Optional[str] = None) -> Hasher:
+    """ Hasher by name, by default the one set by USER_PASSWORD_HASHER
+    (scrypt)
+    """
+    if name is None:
+        name = os.getenv("USER_PASSWORD_HASHER", "scrypt")
+    if name not in HASHERS:
+        raise ValueError("Unknown password hasher: {}".format(name))
+    return HASHERS[name]
+
+
+def identify(encoded: str) -> Optional[Hasher]:
+    """ Hasher that made a stored password, None if unknown
+    """
+    name, sep, _ = encoded.partition("$")
+    if sep:
+        return HASHERS.get(name)
+    return HASHERS['sha256']
+
+
+def make_password(pwd: str) -> str:
+    """ Hash a password with the default hasher
+    """
+    return get_hasher().encode(pwd)
+
+
+def check_password(pwd: str, encoded: str) -> bool:
+    """ Check a password against a stored hash of any known format
+    """
+    hasher = identify(encoded)
+    if hasher is None:
+        return False
+    return hasher.verify(pwd, encoded)
+
+
+def must_update(encoded: str) -> bool:
+    """ Check if a stored hash should be replaced by a new one: other
+    hasher than the default, or same hasher with another cost
+    """
+    hasher = identify(encoded)
+    default = get_hasher()
+    return hasher is not default or hasher.must_update(encoded)
+
+
+def benchmark(seconds: float = 1.0) -> Dict[str, float]:
+    """ Verifies per second of each registered hasher
+    """
+    results = {}
+    for name, hasher in HASHERS.items():
+        encoded = hasher.encode("benchmark")
+        count = 0
+        start = time.perf_counter()
+        while True:
+            hasher.verify("benchmark", encoded)
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= seconds:
+                break
+        results[name] = count / elapsed
+    return results
+
+
+register(SHA256Hasher())
+if hasattr(hashlib, 'scrypt'):
+    register(ScryptHasher())
+for hasher_class in (BcryptHasher, Argon2Hasher):
+    try:
+        register(hasher_class())
+    except ImportError:
+        pass
+
+
+if __name__ == "__main__":
+    for name, rate in benchmark().items():
+        print("{}: {:.1f} verifies/sec".format(name, rate))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+""" Journal module
+"""
+from typing import Iterator
+import json
+import os
+import threading
+import time
+
+
+FSYNC_POLICIES = ('always', 'batch', 'interval')
+
+
+class Journal():
+    """ Append-only file of JSON lines, one per change
+    """
+
+    def __init__(self, file_path: str, fsync: str = 'always',
+                 batch_size: int = 100, interval: float = 1.0):
+        """ Open the journal for appending
+
+        fsync decides when appended lines reach the disk:
+          - always: after every line
+          - batch: after batch_size lines
+          - interval: at most interval seconds after a line
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: {}".format(fsync))
+        self.file_path = file_path
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._file = open(file_path, 'a')
+        self._unsynced = 0
+        if fsync == 'interval':
+            syncer = threading.Thread(target=self._sync_every_interval,
+                                      daemon=True)
+            syncer.start()
+
+    def append(self, entry: dict, sync: bool = True):
+        """ Append one entry
+
+        With sync False the fsync policy is skipped, the caller is
+        expected to call sync() later.
+        """
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if not sync:
+                return
+            if self.fsync == 'always' or \
+                    (self.fsync == 'batch' and
+                     self._unsynced >= self.batch_size):
+                self._sync()
+
+    def size(self) -> int:
+        """ Size of the journal in bytes
+        """
+        with self._lock:
+            return self._file.tell()
+
+    def rotate(self) -> str:
+        """ Move the current journal aside and start an empty one
+
+        Returns the path the previous entries were moved to.
+        """
+        old_path = self.file_path + ".old"
+        with self._lock:
+            self._sync()
+            self._file.close()
+            os.replace(self.file_path, old_path)
+            self._file = open(self.file_path, 'a')
+        return old_path
+
+    def sync(self):
+        """ Force appended entries to the disk
+        """
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        """ Sync and close the journal
+        """
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+
+    def _sync(self):
+        """ fsync the file, the lock must be held
+        """
+        if self._unsynced and not self._file.closed:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def _sync_every_interval(self):
+        """ Background loop of the interval policy
+        """
+        while not self._file.closed:
+            time.sleep(self.interval)
+            self.sync()
+
+    @staticmethod
+    def replay(file_path: str) -> Iterator[dict]:
+        """ Entries of a journal file, in order
+
+        A last line cut short by a crash is ignored.
+        """
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+""" Snapshot module
+"""
+from typing import Any, BinaryIO, Iterable, List, Tuple
+import json
+import mmap
+import struct
+
+
+MAGIC = b"BSNAP1\n"
+HEADER_SIZE = struct.Struct(">Q")
+
+
+def write_snapshot(f: BinaryIO, records: Iterable[Tuple[str, bytes, dict]],
+                   attributes: List[str]):
+    """ Write records to a binary snapshot file
+
+    Each record is (object ID, JSON bytes of the object, indexed
+    attribute values). The header holds the IDs, the length of each
+    object and the values of attributes, so a reader can build its
+    offset index and the attribute indexes without parsing objects.
+    """
+    ids = []
+    lengths = []
+    values = {attribute: [] for attribute in attributes}
+    chunks = []
+    for obj_id, data, index_values in records:
+        ids.append(obj_id)
+        lengths.append(len(data))
+        for attribute in attributes:
+            values[attribute].append(index_values.get(attribute))
+        chunks.append(data)
+
+    header = json.dumps({'ids': ids, 'lengths': lengths,
+                         'indexes': values}).encode()
+    f.write(MAGIC)
+    f.write(HEADER_SIZE.pack(len(header)))
+    f.write(header)
+    for data in chunks:
+        f.write(data)
+
+
+class Snapshot():
+    """ Memory-mapped binary snapshot, read one object at a time
+    """
+
+    def __init__(self, file_path: str):
+        """ Map the file and load its header
+        """
+        with open(file_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a snapshot".format(file_path))
+
+        start = len(MAGIC) + HEADER_SIZE.size
+        header_size, = HEADER_SIZE.unpack(self._map[len(MAGIC):start])
+        header = json.loads(self._map[start:start + header_size])
+        self.ids = header['ids']
+        self._index_values = header['indexes']
+
+        self._spans = {}
+        offset = start + header_size
+        for position, (obj_id, length) in enumerate(zip(self.ids,
+                                                        header['lengths'])):
+            self._spans[obj_id] = (position, offset, length)
+            offset += length
+
+    def raw(self, obj_id: str) -> bytes:
+        """ JSON bytes of one object
+        """
+        _, offset, length = self._spans[obj_id]
+        return self._map[offset:offset + length]
+
+    def read(self, obj_id: str) -> dict:
+        """ JSON dictionary of one object
+        """
+        return json.loads(self.raw(obj_id))
+
+    def index_value(self, obj_id: str, attribute: str) -> Any:
+        """ Value of an indexed attribute, KeyError if not stored
+        """
+        position = self._spans[obj_id][0]
+        return self._index_values[attribute][position]
@@ -4,12 +4,37 @@ Basic Flask app
 """
 from flask import Flask, jsonify, request, Response, make_response, abort
 from flask import redirect
-from auth import Auth
+from auth import Auth, HashPoolSaturated
 from typing import Dict, Any
+import os
 
 
 app = Flask(__name__)
 AUTH = Auth()
+# Limits of one POST /users/bulk request. Each row costs one bcrypt
+# hash (about 170 ms at cost 11) and the pool runs one per CPU, so 100
+# rows stay within a usual 30 s request timeout even on a single core
+BULK_MAX_ROWS = int(os.getenv("AUTH_BULK_MAX_ROWS", "100"))
+BULK_MAX_BYTES = int(os.getenv("AUTH_BULK_MAX_BYTES", str(64 * 1024)))
+
+
+@app.teardown_appcontext
+def close_session(exception: BaseException = None) -> None:
+    """
+    Releases the database session of the request.
+    """
+    AUTH.close_session()
+
+
+@app.errorhandler(HashPoolSaturated)
+def hash_pool_saturated(error: HashPoolSaturated) -> Response:
+    """
+    Answers at once with 503 when password hashing is saturated.
+    """
+    response = jsonify({"message": "service busy, try again later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
 
 
 @app.route("/", methods=["GET"])
@@ -36,6 +61,34 @@ def users():
         return jsonify({"message": "email already registered"}), 400
 
 
+@app.route("/users/bulk", methods=["POST"])
+def users_bulk():
+    """
+    POST /users/bulk endpoint to register many users.
+
+    Expects a JSON list of at most AUTH_BULK_MAX_ROWS (100)
+    {"email", "password"} objects, in a body of at most
+    AUTH_BULK_MAX_BYTES (64 KiB), and answers with the number of users
+    created and the rows that failed. Larger imports are split by
+    the caller.
+    """
+    if request.content_length is None:
+        abort(411)
+    if request.content_length > BULK_MAX_BYTES:
+        abort(413)
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        abort(400)
+    if len(rows) > BULK_MAX_ROWS:
+        abort(413)
+
+    # One chunk, so a 503 from the hash pool means nothing was created
+    report = AUTH.register_users(
+        ((row.get("email"), row.get("password")) if isinstance(row, dict)
+         else None for row in rows), chunk_size=BULK_MAX_ROWS)
+    return jsonify(report)
+
+
 @app.route("/sessions", methods=["POST"])
 def login():
     """
@@ -69,7 +122,7 @@ def logout():
     if not user:
         abort(403)
 
-    AUTH.destroy_session(user.id)
+    AUTH.destroy_session(user.id, session_id)
 
     return redirect("/")
 
@@ -3,31 +3,207 @@
 This module provides authentication-related utilities.
 """
 import bcrypt
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from db import DB, NoResultFound
+from sqlalchemy.exc import IntegrityError
+from functools import lru_cache
+from itertools import islice
+from session_store import session_store_from_env
 from user import User
+import os
+import threading
+import time
 import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 from typing import Union
 from uuid import uuid4
 
 
-def _hash_password(password: str) -> bytes:
+def _calibrate_rounds(budget_ms: float, min_rounds: int = 12,
+                      max_rounds: int = 16) -> int:
+    """
+    Finds the highest bcrypt cost that fits a latency budget.
+
+    Args:
+        budget_ms (float): The time one hash may take, in milliseconds.
+        min_rounds (int): The lowest cost to return.
+        max_rounds (int): The highest cost to try.
+
+    Returns:
+        int: The bcrypt cost to use on this machine.
+    """
+    rounds = min_rounds
+    while rounds < max_rounds:
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # Each extra round doubles the work
+        if elapsed_ms * 2 > budget_ms:
+            break
+        rounds += 1
+    return rounds
+
+
+@lru_cache(maxsize=None)
+def _target_rounds() -> int:
+    """
+    Returns the bcrypt cost for new hashes, calibrated once against
+    AUTH_HASH_BUDGET_MS (250 ms by default) and never below
+    AUTH_HASH_MIN_ROUNDS (12, the bcrypt default), so a slow or
+    loaded host doesn't weaken new hashes.
+
+    Returns:
+        int: The calibrated bcrypt cost.
+    """
+    return _calibrate_rounds(
+        float(os.getenv("AUTH_HASH_BUDGET_MS", "250")),
+        int(os.getenv("AUTH_HASH_MIN_ROUNDS", "12")))
+
+
+def _hash_rounds(hashed_password: bytes) -> int:
+    """
+    Reads the bcrypt cost stored in a hashed password.
+
+    Args:
+        hashed_password (bytes): A bcrypt hash.
+
+    Returns:
+        int: The cost the hash was made with.
+    """
+    return int(hashed_password.split(b"$")[2])
+
+
+def _hash_password(password: str, rounds: Optional[int] = None) -> bytes:
     """
     Hashes a password using bcrypt.
 
     Args:
         password (str): The plaintext password to hash.
+        rounds (int): The bcrypt cost, the calibrated one by default.
 
     Returns:
         bytes: The hashed password.
     """
     password_bytes = password.encode("utf-8")
-    salt = bcrypt.gensalt()
+    if rounds is None:
+        rounds = _target_rounds()
+    salt = bcrypt.gensalt(rounds)
 
     hashed = bcrypt.hashpw(password_bytes, salt)
 
     return hashed
 
 
+def _hash_or_error(password: str, rounds: int
+                   ) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Hashes a password, reporting what bcrypt rejects instead of
+    raising, such as passwords longer than 72 bytes.
+
+    Args:
+        password (str): The plaintext password to hash.
+        rounds (int): The bcrypt cost.
+
+    Returns:
+        tuple: The hash and None, or None and the reason it failed.
+    """
+    try:
+        return _hash_password(password, rounds), None
+    except ValueError as error:
+        return None, str(error)
+
+
+def _check_password(password: str, hashed_password: bytes) -> bool:
+    """
+    Checks a password against its bcrypt hash.
+
+    Args:
+        password (str): The plaintext password to check.
+        hashed_password (bytes): The stored bcrypt hash.
+
+    Returns:
+        bool: True if the password matches.
+    """
+    return bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+
+
+class HashPoolSaturated(Exception):
+    """Raised when the hash pool has no room for another task.
+    """
+
+
+class HashPool:
+    """Bounded pool that runs bcrypt work off the request thread.
+
+    At most workers tasks run at once and max_queue more may wait.
+    Past that, run() fails fast with HashPoolSaturated instead of
+    letting requests pile up behind the hashes.
+    """
+
+    def __init__(self, workers: int, max_queue: int,
+                 processes: bool = False):
+        """
+        Starts the pool.
+
+        Args:
+            workers (int): The number of hashes run at once.
+            max_queue (int): The number of hashes that may wait.
+            processes (bool): Use processes instead of threads.
+        """
+        executor_class = ProcessPoolExecutor if processes \
+            else ThreadPoolExecutor
+        self.workers = workers
+        self._executor = executor_class(workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def submit(self, func: Callable, *args: Any) -> Future:
+        """
+        Schedules func(*args) on the pool.
+
+        Raises:
+            HashPoolSaturated: If all workers are busy and the
+            queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HashPoolSaturated()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, func: Callable, *args: Any) -> Any:
+        """
+        Runs func(*args) on the pool and waits for its result.
+
+        Raises:
+            HashPoolSaturated: If all workers are busy and the
+            queue is full.
+        """
+        return self.submit(func, *args).result()
+
+
+def _hash_pool_from_env() -> Optional[HashPool]:
+    """
+    Builds the hash pool configured by AUTH_HASH_WORKERS (0, hash on
+    the request thread, by default), AUTH_HASH_QUEUE (twice the
+    workers by default) and AUTH_HASH_POOL (thread or process).
+
+    Returns:
+        HashPool: The pool, or None when hashing runs inline.
+    """
+    workers = int(os.getenv("AUTH_HASH_WORKERS", "0"))
+    if workers <= 0:
+        return None
+    max_queue = int(os.getenv("AUTH_HASH_QUEUE", str(2 * workers)))
+    processes = os.getenv("AUTH_HASH_POOL", "thread") == "process"
+    return HashPool(workers, max_queue, processes)
+
+
 def _generate_uuid() -> str:
     """
     Generate a new UUID.
@@ -44,6 +220,65 @@ class Auth:
 
     def __init__(self):
         self._db = DB()
+        # Calibrate at startup rather than on the first login
+        self._rounds = _target_rounds()
+        self._rehash_executor = ThreadPoolExecutor(max_workers=1)
+        # IDs of the users with a rehash queued or running
+        self._rehash_pending = set()
+        self._rehash_lock = threading.Lock()
+        self._hash_pool = _hash_pool_from_env()
+        # Bulk registrations never hash on the request thread: without
+        # a configured pool they share this one, one worker per CPU
+        self._bulk_pool = self._hash_pool
+        if self._bulk_pool is None:
+            workers = os.cpu_count() or 1
+            self._bulk_pool = HashPool(workers, workers)
+        self._sessions = session_store_from_env(self._db)
+
+    def _run_hash(self, func: Callable, *args: Any) -> Any:
+        """
+        Runs a bcrypt function on the hash pool, or inline when no
+        pool is configured.
+
+        Raises:
+            HashPoolSaturated: If the hash pool is full.
+        """
+        if self._hash_pool is None:
+            return func(*args)
+        return self._hash_pool.run(func, *args)
+
+    def _hash_many(self, passwords: List[str]
+                   ) -> List[Tuple[Optional[bytes], Optional[str]]]:
+        """
+        Hashes passwords in parallel on the hash pool, or on the
+        shared bulk pool when none is configured, at most one per
+        worker at a time so single requests keep room in the queue.
+
+        Returns:
+            list: (hash, None) or (None, reason) per password, in order.
+
+        Raises:
+            HashPoolSaturated: If the pool is full before any of these
+            passwords could be scheduled.
+        """
+        pool = self._bulk_pool
+        results = []
+        pending = deque()
+        for password in passwords:
+            while True:
+                if len(pending) >= pool.workers:
+                    results.append(pending.popleft().result())
+                try:
+                    pending.append(pool.submit(
+                        _hash_or_error, password, self._rounds))
+                    break
+                except HashPoolSaturated:
+                    if not pending:
+                        raise
+                    # Wait for our own work rather than failing midway
+                    results.append(pending.popleft().result())
+        results.extend(future.result() for future in pending)
+        return results
 
     def register_user(self, email: str, password: str) -> User:
         """
@@ -58,16 +293,120 @@ class Auth:
 
         Raises:
             ValueError: If a user with the provided email already exists.
+            HashPoolSaturated: If the hash pool is full.
         """
         try:
             self._db.find_user_by(email=email)
             raise ValueError(f"User {email} already exists")
         except NoResultFound:
-            hashed_pw = _hash_password(password)
-            user = self._db.add_user(email, hashed_pw)
+            hashed_pw = self._run_hash(_hash_password, password,
+                                       self._rounds)
+            try:
+                user = self._db.add_user(email, hashed_pw)
+            except IntegrityError:
+                # Registered by a concurrent request since the lookup
+                raise ValueError(f"User {email} already exists")
 
             return user
 
+    def register_users(self, users: Iterable[Tuple[str, str]],
+                       chunk_size: int = 1000) -> Dict[str, Any]:
+        """
+        Registers many users at once.
+
+        Users are read chunk_size at a time. For each chunk, existing
+        emails are looked up with IN queries, passwords are hashed in
+        parallel on the hash pool (on a shared pool of one worker per
+        CPU without one) and new users are inserted in one transaction.
+
+        Args:
+            users (Iterable): (email, password) pairs.
+            chunk_size (int): The number of users per transaction.
+
+        Returns:
+            dict: "created", the number of users registered, and
+            "errors", a list of {"row", "email", "message"} for the
+            users that were not, with row their position in users.
+
+        Raises:
+            HashPoolSaturated: If the pool is full. Users of the
+            chunks before are registered already.
+        """
+        created = 0
+        errors = []
+        seen = set()
+        rows = enumerate(users)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            valid = []
+            for row, user in chunk:
+                try:
+                    email, password = user
+                except (TypeError, ValueError):
+                    email, password = None, None
+                if not isinstance(email, str) or not email or \
+                        not isinstance(password, str) or not password:
+                    errors.append({"row": row, "email": email,
+                                   "message": "email and password "
+                                              "are required"})
+                elif email in seen:
+                    errors.append({"row": row, "email": email,
+                                   "message": "duplicate email"})
+                else:
+                    seen.add(email)
+                    valid.append((row, email, password))
+
+            existing = self._db.find_existing_emails(
+                email for _, email, _ in valid)
+            new = []
+            for row, email, password in valid:
+                if email in existing:
+                    errors.append({"row": row, "email": email,
+                                   "message": "email already registered"})
+                else:
+                    new.append((row, email, password))
+
+            results = self._hash_many([password for _, _, password in new])
+            hashed_users = []
+            for (row, email, _), (hashed, error) in zip(new, results):
+                if error is None:
+                    hashed_users.append((row, email, hashed))
+                else:
+                    errors.append({"row": row, "email": email,
+                                   "message": "invalid password: "
+                                              "{}".format(error)})
+            created += self._add_users(hashed_users, errors)
+
+        errors.sort(key=lambda error: error["row"])
+        return {"created": created, "errors": errors}
+
+    def _add_users(self, users: List[Tuple[int, str, bytes]],
+                   errors: List[Dict[str, Any]]) -> int:
+        """
+        Inserts (row, email, hashed password) users in bulk. If a
+        concurrent registration makes the bulk insert fail, inserts
+        them one by one and reports the conflicting rows in errors.
+
+        Returns:
+            int: The number of users inserted.
+        """
+        try:
+            return self._db.add_users(
+                [(email, hashed) for _, email, hashed in users])
+        except IntegrityError:
+            pass
+        created = 0
+        for row, email, hashed in users:
+            try:
+                self._db.add_user(email, hashed)
+                created += 1
+            except IntegrityError:
+                errors.append({"row": row, "email": email,
+                               "message": "email already registered"})
+        return created
+
     def valid_login(self, email: str, password: str) -> bool:
         """
         Validates user login credentials.
@@ -78,25 +417,87 @@ class Auth:
 
         Returns:
             bool: True if the credentials are valid, False otherwise.
+
+        Raises:
+            HashPoolSaturated: If the hash pool is full.
         """
         try:
             user = self._db.find_user_by(email=email)
 
-            if bcrypt.checkpw(password.encode('utf-8'), user.hashed_password):
+            if self._run_hash(_check_password, password,
+                              user.hashed_password):
+                # Only upgrade, a stronger stored hash is kept as is
+                if _hash_rounds(user.hashed_password) < self._rounds:
+                    self._submit_rehash(user, password)
                 return True
         except NoResultFound:
             return False
 
+    def _submit_rehash(self, user: User, password: str) -> None:
+        """
+        Queues a rehash of the password of user, unless one is
+        already queued or running for that user.
+        """
+        with self._rehash_lock:
+            if user.id in self._rehash_pending:
+                return
+            self._rehash_pending.add(user.id)
+        try:
+            self._rehash_executor.submit(
+                self._rehash, user.id, user.hashed_password, password
+            )
+        except BaseException:
+            with self._rehash_lock:
+                self._rehash_pending.discard(user.id)
+            raise
+
+    def _rehash(self, user_id: int, old_hash: bytes, password: str) -> None:
+        """
+        Hashes password again with the calibrated cost, in the
+        background, and saves it unless the password changed in
+        the meantime.
+
+        Args:
+            user_id (int): The ID of the user who just logged in.
+            old_hash (bytes): The hash the password was verified against.
+            password (str): The plaintext password that was verified.
+        """
+        try:
+            new_hash = _hash_password(password, self._rounds)
+            self._db.update_users(
+                {"id": user_id, "hashed_password": old_hash},
+                hashed_password=new_hash)
+        finally:
+            self._db.close_session()
+            with self._rehash_lock:
+                self._rehash_pending.discard(user_id)
+
+    def close_session(self) -> None:
+        """
+        Releases the database session of the current thread, at the
+        end of each request.
+        """
+        self._db.close_session()
+
     def create_session(self, email: str) -> Union[str, None]:
         """
         Create a new session for the user and return
-        the session ID.
+        the session ID. Earlier sessions of the user stay valid.
+        """
+        return self._sessions.create_for_email(email, self._user_id_of)
+
+    def _user_id_of(self, email: str) -> Optional[int]:
+        """
+        Finds the ID of the user with an email.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            int: The user ID, None if there is no such user.
         """
         try:
-            user = self._db.find_user_by(email=email)
-            session_id = _generate_uuid()
-            self._db.update_user(user.id, session_id=session_id)
-            return session_id
+            return self._db.find_user_by(email=email).id
         except NoResultFound:
             return None
 
@@ -107,26 +508,33 @@ class Auth:
         if session_id is None:
             return None
 
+        user_id = self._sessions.get(session_id)
+        if user_id is None:
+            return None
+
         try:
-            user = self._db.find_user_by(session_id=session_id)
+            user = self._db.find_user_by(id=user_id)
             return user
         except NoResultFound:
             return None
 
-    def destroy_session(self, user_id: int) -> None:
+    def destroy_session(self, user_id: int,
+                        session_id: Optional[str] = None) -> None:
         """Destroy a session for a user given the user's ID.
 
         Args:
             user_id (int): The ID of the user whose session is to be
             destroyed.
+            session_id (str): The session to destroy, all the sessions
+            of the user when None.
         """
         if user_id is None:
             return None
 
-        try:
-            self._db.update_user(user_id, session_id=None)
-        except NoResultFound:
-            return None
+        if session_id is None:
+            self._sessions.delete_user(user_id)
+        elif self._sessions.get(session_id) == user_id:
+            self._sessions.delete(session_id)
 
     def get_reset_password_token(self, email: str) -> str:
         """
@@ -141,13 +549,11 @@ class Auth:
         Raises:
             ValueError: If no user is found with the provided email.
         """
-        user = self._db.find_user_by(email=email)
-        if not user:
-            raise ValueError("User not found")
-
         reset_token = str(uuid4())
 
-        self._db.update_user(user.id, reset_token=reset_token)
+        if not self._db.update_users({"email": email},
+                                     reset_token=reset_token):
+            raise ValueError("User not found")
 
         return reset_token
 
@@ -180,13 +586,21 @@ class Auth:
 
         Raises:
             ValueError: If the reset_token is invalid or not found.
+            HashPoolSaturated: If the hash pool is full.
         """
-        user = self._db.find_user_by(reset_token=reset_token)
-
-        if not user:
+        if reset_token is None:
+            raise ValueError("Invalid reset token")
+        # Cheap indexed lookup first, so a made-up token costs no hash
+        try:
+            self._db.find_user_by(reset_token=reset_token)
+        except NoResultFound:
             raise ValueError("Invalid reset token")
 
-        hashed_password = _hash_password(password)
+        hashed_password = self._run_hash(_hash_password, password,
+                                         self._rounds)
 
-        self._db.update_user(user.id, hashed_password=hashed_password,
-                             reset_token=None)
+        # Matching on the token in the UPDATE also makes it single use
+        if not self._db.update_users({"reset_token": reset_token},
+                                     hashed_password=hashed_password,
+                                     reset_token=None):
+            raise ValueError("Invalid reset token")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the database layer, run against throwaway SQLite
+files in a temporary directory.
+
+lookup times DB.find_user_by on email and on reset_token, with the
+indexes of the users table and after dropping them, for tables of
+several sizes:
+    ./benchmark.py --target lookup --sizes 10000,100000,1000000
+modes compares AUTH_DB_MODE development and production: startup
+time of DB() on a file already holding users, and add_user calls
+per second, one commit each:
+    ./benchmark.py --target modes --existing 100000 --inserts 2000
+"""
+from typing import Callable, List
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def quiet_db(url: str, mode: str) -> "DB":
+    """
+    Opens url as DB in mode (development or production), sending the
+    SQL echo of development mode to /dev/null.
+    """
+    os.environ["AUTH_DB_URL"] = url
+    os.environ["AUTH_DB_MODE"] = mode
+    from db import DB
+    stdout = sys.stdout
+    # The echo handler binds sys.stdout when it is created
+    sys.stdout = open(os.devnull, "w")
+    try:
+        return DB()
+    finally:
+        sys.stdout = stdout
+
+
+def latency(func: Callable[[int], object], count: int) -> float:
+    """
+    Calls func(i) for i in range(count), returns the mean latency in
+    milliseconds.
+    """
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return (time.perf_counter() - start) * 1000 / count
+
+
+def bench_lookup(sizes: List[int], lookups: int) -> None:
+    """
+    Prints the mean latency of find_user_by per column, size and
+    with or without the indexes.
+    """
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            db = quiet_db(f"sqlite:///{directory}/bench.db", "production")
+            for first in range(0, size, 10000):
+                last = min(size, first + 10000)
+                db.add_users([(f"user{i}@example.com", b"hash")
+                              for i in range(first, last)])
+            # One user in a hundred has a pending reset
+            with db._engine.connect() as connection:
+                connection.execute("UPDATE users SET reset_token = "
+                                   "'token' || id WHERE id % 100 = 1")
+            tokens = [f"token{user_id}"
+                      for user_id in range(1, size + 1, 100)]
+            emails = [f"user{random.randrange(size)}@example.com"
+                      for _ in range(lookups)]
+            tokens = [random.choice(tokens) for _ in range(lookups)]
+
+            results = []
+            for indexed in (True, False):
+                if not indexed:
+                    with db._engine.connect() as connection:
+                        connection.execute("DROP INDEX ix_users_email")
+                        connection.execute("DROP INDEX ix_users_reset_token")
+                results.append(latency(
+                    lambda i: db.find_user_by(email=emails[i]), lookups))
+                results.append(latency(
+                    lambda i: db.find_user_by(reset_token=tokens[i]),
+                    lookups))
+                db.close_session()
+            db._engine.dispose()
+        print(f"{size} users: email {results[2]:.2f} -> {results[0]:.2f} ms,"
+              f" reset_token {results[3]:.2f} -> {results[1]:.2f} ms "
+              f"(no index -> index)")
+
+
+def bench_modes(existing: int, inserts: int) -> None:
+    """
+    Prints, per mode, the startup time of DB() on a file holding
+    existing users, how many it kept and the add_user rate.
+    """
+    for mode in ("development", "production"):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{directory}/bench.db"
+            db = quiet_db(url, "production")
+            for first in range(0, existing, 10000):
+                last = min(existing, first + 10000)
+                db.add_users([(f"old{i}@example.com", b"hash")
+                              for i in range(first, last)])
+            db._engine.dispose()
+
+            start = time.perf_counter()
+            db = quiet_db(url, mode)
+            startup = time.perf_counter() - start
+            with db._engine.connect() as connection:
+                kept = connection.execute(
+                    "SELECT COUNT(*) FROM users").scalar()
+
+            start = time.perf_counter()
+            for i in range(inserts):
+                db.add_user(f"new{i}@example.com", b"hash")
+            elapsed = time.perf_counter() - start
+            db.close_session()
+            db._engine.dispose()
+        print(f"{mode}: startup {startup * 1000:.0f} ms, "
+              f"{kept}/{existing} users kept, "
+              f"add_user {inserts / elapsed:.0f}/s")
+
+
+def main() -> None:
+    """
+    Runs the selected benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--target", choices=("lookup", "modes"),
+                        default="lookup")
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="comma-separated numbers of users")
+    parser.add_argument("--lookups", type=int, default=200,
+                        help="lookups per measurement")
+    parser.add_argument("--existing", type=int, default=100000,
+                        help="users in the file before startup")
+    parser.add_argument("--inserts", type=int, default=2000,
+                        help="add_user calls per mode")
+    args = parser.parse_args()
+
+    if args.target == "lookup":
+        bench_lookup([int(size) for size in args.sizes.split(",")],
+                     args.lookups)
+    elif args.target == "modes":
+        bench_modes(args.existing, args.inserts)
+
+
+if __name__ == "__main__":
+    main()
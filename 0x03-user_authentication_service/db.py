@@ -2,32 +2,143 @@
 """DB module
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import Float, String, create_engine, event, inspect, literal
+from sqlalchemy import Index, func, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import InvalidRequestError
-from user import Base, User
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from user import Base, User, UserSession
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import os
+
+
+# Indexes made by older versions, dropped at startup. Sessions moved to
+# their own table, users.session_id is never read any more
+OBSOLETE_INDEXES = {"users": ("ix_users_session_id",)}
+
+
+def _pool_options(url: str) -> Dict[str, Any]:
+    """
+    Connection pool options of create_engine, from DB_POOL_SIZE (5),
+    DB_MAX_OVERFLOW (10), DB_POOL_TIMEOUT (30 seconds),
+    DB_POOL_RECYCLE (-1, never) and DB_POOL_PRE_PING (0)
+    """
+    parsed = make_url(url)
+    if parsed.drivername.startswith("sqlite") and \
+            parsed.database in (None, "", ":memory:"):
+        # An in-memory database lives in its connection: share that
+        # one connection, a pool would hand out empty databases
+        return {"poolclass": StaticPool,
+                "connect_args": {"check_same_thread": False}}
+
+    options = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "-1")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "0") == "1",
+    }
+    if parsed.drivername.startswith("sqlite"):
+        # SQLite file databases get no pool by default, and pysqlite
+        # refuses connections made in another thread
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def _set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any
+                        ) -> None:
+    """
+    Write-ahead logging lets reads run during a write, and
+    synchronous=NORMAL only syncs at checkpoints, which is safe
+    with WAL
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
 
 class DB:
-    """DB class"""
+    """DB class
+
+    AUTH_DB_URL sets the database (sqlite:///a.db by default).
+    AUTH_DB_MODE=production keeps existing data: only missing tables
+    are created, SQL is not echoed and SQLite runs in WAL mode. By
+    default, every start drops and recreates the tables with SQL
+    echoed.
+    """
 
     def __init__(self) -> None:
         """Initialize a new DB instance"""
-        self._engine = create_engine("sqlite:///a.db", echo=True)
-        Base.metadata.drop_all(self._engine)
+        url = os.getenv("AUTH_DB_URL", "sqlite:///a.db")
+        production = os.getenv("AUTH_DB_MODE", "development") == \
+            "production"
+        self._engine = create_engine(url, echo=not production,
+                                     **_pool_options(url))
+        if production and url.startswith("sqlite"):
+            event.listen(self._engine, "connect", _set_sqlite_pragmas)
+        if not production:
+            Base.metadata.drop_all(self._engine)
         Base.metadata.create_all(self._engine)
-        self.__session = None
+        self._create_missing_indexes()
+        self.__session = scoped_session(sessionmaker(bind=self._engine))
+
+    def _create_missing_indexes(self) -> None:
+        """
+        Add the indexes declared by the models to tables made by an
+        older version; create_all skips tables that already exist.
+        Indexes no longer declared are dropped
+        """
+        inspector = inspect(self._engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"]
+                        for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    if index.unique:
+                        self._check_no_duplicates(index)
+                    index.create(self._engine)
+            for name in OBSOLETE_INDEXES.get(table.name, ()):
+                if name in existing:
+                    Index(name, table.c.id).drop(self._engine)
+
+    def _check_no_duplicates(self, index: Index) -> None:
+        """
+        Raise ValueError naming the duplicated values (ten at most) of a
+        unique index about to be added to an existing table
+        """
+        columns = list(index.columns)
+        query = select(columns).group_by(*columns) \
+            .having(func.count() > 1).limit(10)
+        for column in columns:
+            query = query.where(column.isnot(None))
+        with self._engine.connect() as connection:
+            duplicates = [", ".join(str(value) for value in row)
+                          for row in connection.execute(query)]
+        if duplicates:
+            raise ValueError(
+                "Cannot create unique index {}: {} already holds "
+                "duplicates of {}: {}. Remove them, then restart".format(
+                    index.name, index.table.name,
+                    ", ".join(column.name for column in columns),
+                    "; ".join(duplicates)))
 
     @property
     def _session(self) -> Session:
-        """Memoized session object"""
-        if self.__session is None:
-            DBSession = sessionmaker(bind=self._engine)
-            self.__session = DBSession()
-        return self.__session
+        """Session object of the current thread"""
+        return self.__session()
+
+    def close_session(self) -> None:
+        """
+        Close the session of the current thread and give its
+        connection back to the pool
+        """
+        self.__session.remove()
 
     def add_user(self, email: str, hashed_password: str) -> User:
         """
@@ -36,10 +147,48 @@ class DB:
         user = User(email=email, hashed_password=hashed_password)
         session = self._session
         session.add(user)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise
 
         return user
 
+    def add_users(self, users: List[Tuple[str, bytes]]) -> int:
+        """
+        Add (email, hashed_password) users in one transaction with a
+        bulk INSERT, return how many were added
+        """
+        if not users:
+            return 0
+        session = self._session
+        try:
+            session.execute(User.__table__.insert(), [
+                {"email": email, "hashed_password": hashed_password}
+                for email, hashed_password in users])
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise
+
+        return len(users)
+
+    def find_existing_emails(self, emails: Iterable[str],
+                             batch_size: int = 500) -> Set[str]:
+        """
+        Return which of emails belong to users, with one IN query
+        per batch_size emails
+        """
+        emails = list(emails)
+        existing = set()
+        for start in range(0, len(emails), batch_size):
+            batch = emails[start:start + batch_size]
+            existing.update(email for email, in self._session.query(
+                User.email).filter(User.email.in_(batch)))
+
+        return existing
+
     def find_user_by(self, **kwargs) -> User:
         """
         Find a user in the database based on
@@ -54,17 +203,109 @@ class DB:
 
         return user
 
+    @staticmethod
+    def _check_columns(names: Iterable[str]) -> None:
+        """
+        Raise ValueError unless every name is a column of users
+        """
+        columns = User.__table__.columns
+        for name in names:
+            if name not in columns:
+                raise ValueError()
+
     def update_user(self, user_id: int, **kwargs) -> None:
         """
-        update user
+        update user, in a single UPDATE statement
         """
-        try:
-            user = self.find_user_by(id=user_id)
-            for key, value in kwargs.items():
-                if hasattr(user, key):
-                    setattr(user, key, value)
-                else:
-                    raise ValueError()
-            self._session.commit()
-        except NoResultFound:
+        self._check_columns(kwargs)
+        if not kwargs:
+            self.find_user_by(id=user_id)
+            return
+        if not self.update_users({"id": user_id}, **kwargs):
             raise NoResultFound()
+
+    def update_users(self, criteria: Dict[str, Any], **kwargs) -> int:
+        """
+        Set columns of the users matching criteria, in a single
+        UPDATE statement, return how many were updated
+        """
+        if not criteria:
+            raise InvalidRequestError("Invalid")
+        self._check_columns(kwargs)
+        try:
+            count = self._session.query(User).filter_by(**criteria).update(
+                kwargs, synchronize_session="evaluate")
+        except InvalidRequestError:
+            self._session.rollback()
+            raise InvalidRequestError("Invalid")
+        self._session.commit()
+
+        return count
+
+    def add_session(self, session_id: str, user_id: int,
+                    expires_at: Optional[float] = None) -> UserSession:
+        """
+        Add a new session for a user
+        """
+        user_session = UserSession(id=session_id, user_id=user_id,
+                                   expires_at=expires_at)
+        session = self._session
+        session.add(user_session)
+        session.commit()
+
+        return user_session
+
+    def create_session_for_email(self, session_id: str, email: str,
+                                 expires_at: Optional[float] = None
+                                 ) -> bool:
+        """
+        Add a new session for the user with email, in a single
+        INSERT ... SELECT statement, return False if there is no
+        such user
+        """
+        columns = select([literal(session_id, String), User.id,
+                          literal(expires_at, Float)]).where(
+            User.email == email)
+        statement = UserSession.__table__.insert().from_select(
+            ["id", "user_id", "expires_at"], columns)
+        result = self._session.execute(statement)
+        self._session.commit()
+
+        return result.rowcount == 1
+
+    def find_session(self, session_id: str) -> UserSession:
+        """
+        Find a session by its ID
+        """
+        user_session = self._session.query(UserSession).get(session_id)
+        if user_session is None:
+            raise NoResultFound("Not found")
+
+        return user_session
+
+    def delete_sessions(self, **kwargs) -> int:
+        """
+        Delete the sessions matching input arguments,
+        return how many were deleted
+        """
+        if not kwargs:
+            raise InvalidRequestError("Invalid")
+        try:
+            count = self._session.query(UserSession).filter_by(
+                **kwargs).delete(synchronize_session=False)
+        except InvalidRequestError:
+            raise InvalidRequestError("Invalid")
+        self._session.commit()
+
+        return count
+
+    def delete_expired_sessions(self, now: float) -> int:
+        """
+        Delete the sessions expired at now (Unix time),
+        return how many were deleted
+        """
+        count = self._session.query(UserSession).filter(
+            UserSession.expires_at <= now).delete(synchronize_session=False)
+        self._session.commit()
+
+        return count
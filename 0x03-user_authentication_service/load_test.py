@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Load test of the app: logs one user in (POST /sessions) or reads its
+profile (GET /profile) from many threads and reports throughput, tail
+latency and status codes.
+
+Run the app, then for instance:
+    ./load_test.py --threads 32 --requests 500
+Compare AUTH_HASH_WORKERS unset (hash on the request thread) with
+AUTH_HASH_WORKERS=4 AUTH_HASH_QUEUE=8 on the app side. To see how
+throughput grows with concurrency, give several thread counts:
+    ./load_test.py --target profile --threads 1,2,4,8,16
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import argparse
+import time
+
+
+def send(request: Request) -> int:
+    """
+    Sends a request and returns the status code.
+    """
+    try:
+        with urlopen(request) as response:
+            return response.status
+    except HTTPError as error:
+        return error.code
+
+
+def post(url: str, data: dict) -> int:
+    """
+    Posts a form and returns the status code.
+    """
+    return send(Request(url, urlencode(data).encode()))
+
+
+def session_cookie(url: str, email: str, password: str) -> str:
+    """
+    Logs in and returns the session_id cookie.
+    """
+    data = urlencode({"email": email, "password": password}).encode()
+    with urlopen(f"{url}/sessions", data) as response:
+        return response.headers["Set-Cookie"].split(";")[0]
+
+
+def log_in(url: str, email: str, password: str) -> Tuple[int, float]:
+    """
+    Logs in once, returns the status code and the latency in seconds.
+    """
+    start = time.perf_counter()
+    status = post(f"{url}/sessions", {"email": email, "password": password})
+    return status, time.perf_counter() - start
+
+
+def get_profile(url: str, cookie: str) -> Tuple[int, float]:
+    """
+    Reads the profile once, returns the status code and the latency
+    in seconds.
+    """
+    start = time.perf_counter()
+    status = send(Request(f"{url}/profile", headers={"Cookie": cookie}))
+    return status, time.perf_counter() - start
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """
+    Returns a percentile of sorted latencies.
+    """
+    index = min(len(latencies) - 1, int(fraction * len(latencies)))
+    return latencies[index]
+
+
+def run(task: Callable[[], Tuple[int, float]], threads: int,
+        requests: int) -> None:
+    """
+    Runs task requests times on threads threads and prints the report.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(lambda _: task(), range(requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = Counter(status for status, _ in results)
+    ok = sorted(latency for status, latency in results if status == 200)
+    print(f"{requests} requests, {threads} threads, {elapsed:.2f}s")
+    print("status codes: " + ", ".join(
+        f"{status}={count}" for status, count in sorted(statuses.items())))
+    print(f"successes/sec: {len(ok) / elapsed:.1f}")
+    if ok:
+        print("latency of 200s (ms): " + ", ".join(
+            f"p{int(fraction * 100)}={percentile(ok, fraction) * 1000:.0f}"
+            for fraction in (0.5, 0.95, 0.99)))
+    rejected = sorted(latency for status, latency in results
+                      if status == 503)
+    if rejected:
+        print(f"latency of 503s (ms): "
+              f"p50={percentile(rejected, 0.5) * 1000:.0f}")
+
+
+def main() -> None:
+    """
+    Runs the load test once per thread count.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--email", default="load@test.com")
+    parser.add_argument("--password", default="load-test")
+    parser.add_argument("--target", choices=("login", "profile"),
+                        default="login")
+    parser.add_argument("--threads", default="16",
+                        help="thread count, or comma-separated counts")
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    # 400 means the user is already registered
+    post(f"{args.url}/users",
+         {"email": args.email, "password": args.password})
+    if args.target == "login":
+        def task() -> Tuple[int, float]:
+            """
+            One login.
+            """
+            return log_in(args.url, args.email, args.password)
+    else:
+        cookie = session_cookie(args.url, args.email, args.password)
+
+        def task() -> Tuple[int, float]:
+            """
+            One profile read.
+            """
+            return get_profile(args.url, cookie)
+
+    for threads in args.threads.split(","):
+        run(task, int(threads), args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""
+Session stores: where session IDs are mapped to user IDs.
+"""
+from collections import OrderedDict
+from db import DB, NoResultFound
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+import os
+import threading
+import time
+import uuid
+
+
+class StoredSession(NamedTuple):
+    """
+    A session as kept by a store.
+    """
+    user_id: int
+    # Unix time, None for a session that never expires
+    expires_at: Optional[float]
+
+
+class SessionStore:
+    """
+    Base class of the session stores.
+
+    Subclasses implement add, lookup, delete and delete_user, and
+    purge_expired when expired sessions are not dropped by the
+    backend itself. A user may hold any number of sessions, each
+    with its own expiry.
+    """
+
+    # Seconds between two purges of expired sessions
+    purge_interval = 300.0
+
+    def __init__(self, ttl: Optional[float] = None):
+        """
+        Args:
+            ttl (float): The lifetime of new sessions in seconds,
+            None for sessions that never expire.
+        """
+        self.ttl = ttl
+        self._purge_lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def purge_expired(self) -> int:
+        """
+        Deletes the expired sessions, returns how many were deleted.
+        """
+        return 0
+
+    def _maybe_purge(self) -> None:
+        """
+        Purges expired sessions if purge_interval has passed since
+        the last purge, from whichever request gets there first.
+        """
+        now = time.time()
+        with self._purge_lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.purge_interval
+        self.purge_expired()
+
+    def create(self, user_id: int) -> str:
+        """
+        Creates a session for a user.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            str: The new session ID.
+        """
+        self._maybe_purge()
+        session_id = str(uuid.uuid4())
+        self.add(session_id, user_id, self._expiry())
+        return session_id
+
+    def create_for_email(self, email: str,
+                         user_id_of: Callable[[str], Optional[int]]
+                         ) -> Optional[str]:
+        """
+        Creates a session for the user with an email.
+
+        Args:
+            email (str): The email of the user.
+            user_id_of: Finds the ID of the user with an email, None
+            if there is none. Stores that can join on the users
+            themselves do not call it.
+
+        Returns:
+            str: The new session ID, None if there is no such user.
+        """
+        user_id = user_id_of(email)
+        if user_id is None:
+            return None
+        return self.create(user_id)
+
+    def _expiry(self) -> Optional[float]:
+        """
+        Expiry of a session created now.
+        """
+        return None if self.ttl is None else time.time() + self.ttl
+
+    def get(self, session_id: str) -> Optional[int]:
+        """
+        Finds the user of a live session.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            int: The user ID, None if the session is unknown or expired.
+        """
+        stored = self.lookup(session_id)
+        if stored is None:
+            return None
+        if stored.expires_at is not None and stored.expires_at <= time.time():
+            self.delete(session_id)
+            return None
+        return stored.user_id
+
+    def add(self, session_id: str, user_id: int,
+            expires_at: Optional[float]) -> None:
+        """
+        Stores a session.
+        """
+        raise NotImplementedError
+
+    def lookup(self, session_id: str) -> Optional[StoredSession]:
+        """
+        Reads a session, expired or not, None if unknown.
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        """
+        Deletes one session.
+        """
+        raise NotImplementedError
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Deletes every session of a user.
+        """
+        raise NotImplementedError
+
+
+class SQLSessionStore(SessionStore):
+    """
+    Sessions in the sessions table, looked up by primary key.
+    """
+
+    def __init__(self, db: DB, ttl: Optional[float] = None):
+        """
+        Args:
+            db (DB): The database holding the sessions table.
+            ttl (float): The lifetime of new sessions in seconds.
+        """
+        super().__init__(ttl)
+        self._db = db
+
+    def add(self, session_id: str, user_id: int,
+            expires_at: Optional[float]) -> None:
+        """
+        Stores a session.
+        """
+        self._db.add_session(session_id, user_id, expires_at)
+
+    def create_for_email(self, email: str,
+                         user_id_of: Callable[[str], Optional[int]]
+                         ) -> Optional[str]:
+        """
+        Creates a session for the user with an email, in one
+        statement.
+        """
+        self._maybe_purge()
+        session_id = str(uuid.uuid4())
+        if not self._db.create_session_for_email(session_id, email,
+                                                 self._expiry()):
+            return None
+        return session_id
+
+    def lookup(self, session_id: str) -> Optional[StoredSession]:
+        """
+        Reads a session, None if unknown.
+        """
+        try:
+            user_session = self._db.find_session(session_id)
+        except NoResultFound:
+            return None
+        return StoredSession(user_session.user_id, user_session.expires_at)
+
+    def delete(self, session_id: str) -> None:
+        """
+        Deletes one session.
+        """
+        self._db.delete_sessions(id=session_id)
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Deletes every session of a user.
+        """
+        self._db.delete_sessions(user_id=user_id)
+
+    def purge_expired(self) -> int:
+        """
+        Deletes the expired sessions, returns how many were deleted.
+        """
+        return self._db.delete_expired_sessions(time.time())
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions in process memory. They are lost on restart and not
+    shared between processes. This is the only copy of the sessions:
+    past max_size, the least recently used one is evicted, which logs
+    its user out.
+    """
+
+    def __init__(self, ttl: Optional[float] = None,
+                 max_size: int = 100000):
+        """
+        Args:
+            ttl (float): The lifetime of new sessions in seconds.
+            max_size (int): The number of sessions kept at most.
+        """
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._by_user = {}
+
+    def add(self, session_id: str, user_id: int,
+            expires_at: Optional[float]) -> None:
+        """
+        Stores a session, evicting the least recently used ones.
+        """
+        with self._lock:
+            self._remove(session_id)
+            self._sessions[session_id] = StoredSession(user_id, expires_at)
+            self._by_user.setdefault(user_id, set()).add(session_id)
+            while len(self._sessions) > self.max_size:
+                self._remove(next(iter(self._sessions)))
+
+    def lookup(self, session_id: str) -> Optional[StoredSession]:
+        """
+        Reads a session, None if unknown.
+        """
+        with self._lock:
+            stored = self._sessions.get(session_id)
+            if stored is not None:
+                self._sessions.move_to_end(session_id)
+            return stored
+
+    def delete(self, session_id: str) -> None:
+        """
+        Deletes one session.
+        """
+        with self._lock:
+            self._remove(session_id)
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Deletes every session of a user.
+        """
+        with self._lock:
+            for session_id in list(self._by_user.get(user_id, ())):
+                self._remove(session_id)
+
+    def purge_expired(self) -> int:
+        """
+        Deletes the expired sessions, returns how many were deleted.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [session_id
+                       for session_id, stored in self._sessions.items()
+                       if stored.expires_at is not None and
+                       stored.expires_at <= now]
+            for session_id in expired:
+                self._remove(session_id)
+        return len(expired)
+
+    def _remove(self, session_id: str) -> None:
+        """
+        Forgets a session, the lock must be held.
+        """
+        stored = self._sessions.pop(session_id, None)
+        if stored is None:
+            return
+        user_sessions = self._by_user[stored.user_id]
+        user_sessions.discard(session_id)
+        if not user_sessions:
+            del self._by_user[stored.user_id]
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the few Redis commands RedisSessionStore
+    uses, for development and tests without a Redis server.
+    """
+
+    def __init__(self):
+        """
+        Starts empty.
+        """
+        self._lock = threading.Lock()
+        # name -> (value or {member: score}, expires_at)
+        self._keys = {}
+
+    def _live(self, name: str) -> Any:
+        """
+        Value of a key, None once expired, the lock must be held.
+        """
+        value, expires_at = self._keys.get(name, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self._keys[name]
+            return None
+        return value
+
+    def get(self, name: str) -> Optional[bytes]:
+        """
+        GET.
+        """
+        with self._lock:
+            return self._live(name)
+
+    def set(self, name: str, value: Any, ex: Optional[int] = None) -> bool:
+        """
+        SET with an optional expiry in seconds.
+        """
+        expires_at = None if ex is None else time.time() + ex
+        with self._lock:
+            self._keys[name] = (str(value).encode(), expires_at)
+        return True
+
+    def expire(self, name: str, seconds: int) -> bool:
+        """
+        EXPIRE.
+        """
+        with self._lock:
+            value = self._live(name)
+            if value is None:
+                return False
+            self._keys[name] = (value, time.time() + seconds)
+        return True
+
+    def delete(self, *names: str) -> int:
+        """
+        DEL.
+        """
+        with self._lock:
+            return sum(self._keys.pop(name, None) is not None
+                       for name in names)
+
+    def zadd(self, name: str, mapping: Dict[str, float]) -> int:
+        """
+        ZADD.
+        """
+        with self._lock:
+            members = self._live(name)
+            if members is None:
+                members = {}
+                self._keys[name] = (members, None)
+            before = len(members)
+            members.update((str(member).encode(), float(score))
+                           for member, score in mapping.items())
+            return len(members) - before
+
+    def zrem(self, name: str, *values: Any) -> int:
+        """
+        ZREM.
+        """
+        with self._lock:
+            members = self._live(name) or {}
+            count = sum(members.pop(str(value).encode(), None) is not None
+                        for value in values)
+            if not members:
+                self._keys.pop(name, None)
+            return count
+
+    def zremrangebyscore(self, name: str, min: float, max: float) -> int:
+        """
+        ZREMRANGEBYSCORE.
+        """
+        with self._lock:
+            members = self._live(name) or {}
+            removed = [member for member, score in members.items()
+                       if float(min) <= score <= float(max)]
+            for member in removed:
+                del members[member]
+            if not members:
+                self._keys.pop(name, None)
+            return len(removed)
+
+    def zrange(self, name: str, start: int, end: int) -> List[bytes]:
+        """
+        ZRANGE, lowest scores first.
+        """
+        with self._lock:
+            members = self._live(name) or {}
+            ordered = sorted(members, key=members.get)
+        return ordered[start:None if end == -1 else end + 1]
+
+
+def _text(value: Any) -> str:
+    """
+    Decodes a Redis reply, bytes unless decode_responses is set.
+    """
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions in Redis, or anything with the same key and sorted set
+    commands, such as FakeRedis. Redis expires the session keys
+    itself. The sessions of a user are a sorted set scored by expiry,
+    trimmed of expired members on each new session and expiring with
+    its latest session.
+    """
+
+    def __init__(self, client: Any, ttl: Optional[float] = None,
+                 prefix: str = "auth:"):
+        """
+        Args:
+            client: A redis.Redis or compatible client.
+            ttl (float): The lifetime of new sessions in seconds.
+            prefix (str): The prefix of every key.
+        """
+        super().__init__(ttl)
+        self._client = client
+        self._prefix = prefix
+
+    def _session_key(self, session_id: str) -> str:
+        """
+        Key of a session.
+        """
+        return "{}session:{}".format(self._prefix, session_id)
+
+    def _user_key(self, user_id: int) -> str:
+        """
+        Key of the sorted set of session IDs of a user.
+        """
+        return "{}user_sessions:{}".format(self._prefix, user_id)
+
+    def add(self, session_id: str, user_id: int,
+            expires_at: Optional[float]) -> None:
+        """
+        Stores a session, with a Redis expiry when it has one.
+        """
+        ex = None
+        if expires_at is not None:
+            ex = max(1, int(expires_at - time.time()) + 1)
+        value = "{} {}".format(user_id, "" if expires_at is None
+                               else expires_at)
+        self._client.set(self._session_key(session_id), value, ex=ex)
+        user_key = self._user_key(user_id)
+        self._client.zremrangebyscore(user_key, "-inf", time.time())
+        self._client.zadd(user_key, {session_id: float("inf")
+                                     if expires_at is None else expires_at})
+        if ex is not None:
+            self._client.expire(user_key, ex)
+
+    def lookup(self, session_id: str) -> Optional[StoredSession]:
+        """
+        Reads a session, None if unknown or expired.
+        """
+        value = self._client.get(self._session_key(session_id))
+        if value is None:
+            return None
+        user_id, _, expires_at = _text(value).partition(" ")
+        return StoredSession(int(user_id),
+                             float(expires_at) if expires_at else None)
+
+    def delete(self, session_id: str) -> None:
+        """
+        Deletes one session.
+        """
+        stored = self.lookup(session_id)
+        self._client.delete(self._session_key(session_id))
+        if stored is not None:
+            self._client.zrem(self._user_key(stored.user_id), session_id)
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Deletes every session of a user.
+        """
+        user_key = self._user_key(user_id)
+        keys = [self._session_key(_text(session_id))
+                for session_id in self._client.zrange(user_key, 0, -1)]
+        self._client.delete(user_key, *keys)
+
+
+class CachedSessionStore(SessionStore):
+    """
+    A store fronted by an in-memory LRU cache of session lookups.
+
+    Deletes through this object invalidate the cache at once. Deletes
+    made by other processes are seen after at most cache_ttl seconds:
+    with several worker processes, a logged out session keeps working
+    in the other ones for that long.
+    """
+
+    def __init__(self, store: SessionStore, max_size: int = 10000,
+                 cache_ttl: float = 30):
+        """
+        Args:
+            store (SessionStore): The store holding the sessions.
+            max_size (int): The number of lookups cached at most.
+            cache_ttl (float): How long a lookup is cached, in seconds.
+        """
+        super().__init__(store.ttl)
+        self.store = store
+        self.max_size = max_size
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        # session ID -> (StoredSession, cached until)
+        self._cache = OrderedDict()
+        self._by_user = {}
+        # Bumped by deletes, so a lookup that read the store before a
+        # delete does not cache what it read after it
+        self._generation = 0
+
+    def add(self, session_id: str, user_id: int,
+            expires_at: Optional[float]) -> None:
+        """
+        Stores a session in the backing store.
+        """
+        self.store.add(session_id, user_id, expires_at)
+
+    def create_for_email(self, email: str,
+                         user_id_of: Callable[[str], Optional[int]]
+                         ) -> Optional[str]:
+        """
+        Creates a session in the backing store.
+        """
+        return self.store.create_for_email(email, user_id_of)
+
+    def purge_expired(self) -> int:
+        """
+        Deletes the expired sessions of the backing store.
+        """
+        return self.store.purge_expired()
+
+    def lookup(self, session_id: str) -> Optional[StoredSession]:
+        """
+        Reads a session from the cache, or from the backing store.
+        """
+        now = time.time()
+        with self._lock:
+            stored, cached_until = self._cache.get(session_id, (None, 0))
+            if cached_until > now:
+                self._cache.move_to_end(session_id)
+                return stored
+            generation = self._generation
+
+        stored = self.store.lookup(session_id)
+        with self._lock:
+            if generation != self._generation:
+                return stored
+            self._forget(session_id)
+            if stored is None:
+                return None
+            self._cache[session_id] = (stored, now + self.cache_ttl)
+            self._by_user.setdefault(stored.user_id, set()).add(session_id)
+            while len(self._cache) > self.max_size:
+                self._forget(next(iter(self._cache)))
+        return stored
+
+    def delete(self, session_id: str) -> None:
+        """
+        Deletes one session and its cached lookup.
+        """
+        self.store.delete(session_id)
+        with self._lock:
+            self._generation += 1
+            self._forget(session_id)
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Deletes every session of a user and their cached lookups.
+        """
+        self.store.delete_user(user_id)
+        with self._lock:
+            self._generation += 1
+            for session_id in list(self._by_user.get(user_id, ())):
+                self._forget(session_id)
+
+    def _forget(self, session_id: str) -> None:
+        """
+        Drops a cached lookup, the lock must be held.
+        """
+        stored, _ = self._cache.pop(session_id, (None, 0))
+        if stored is None:
+            return
+        user_sessions = self._by_user[stored.user_id]
+        user_sessions.discard(session_id)
+        if not user_sessions:
+            del self._by_user[stored.user_id]
+
+
+def session_store_from_env(db: DB) -> SessionStore:
+    """
+    Builds the session store configured by:
+      - AUTH_SESSION_STORE: sql (default), memory or redis
+      - AUTH_SESSION_TTL: session lifetime in seconds, one week by
+        default, 0 for sessions that never expire. Expired sessions
+        are purged every few minutes
+      - AUTH_SESSION_MEMORY_MAX (100000): sessions kept by the memory
+        store. It holds the only copy, so past that many active
+        sessions the least recently used ones are logged out
+      - AUTH_REDIS_URL: Redis server of the redis store, an
+        in-process FakeRedis when unset
+      - AUTH_SESSION_CACHE_SIZE (10000) and AUTH_SESSION_CACHE_TTL
+        (0 seconds, disabled, by default): lookup cache of sql and
+        redis, not used by memory. Only enable it with a single
+        worker process, or accept that a logout takes up to that long
+        to reach the others
+
+    Args:
+        db (DB): The database of the sql store.
+
+    Returns:
+        SessionStore: The configured store.
+    """
+    kind = os.getenv("AUTH_SESSION_STORE", "sql")
+    ttl = float(os.getenv("AUTH_SESSION_TTL", str(7 * 24 * 3600))) or None
+    cache_size = int(os.getenv("AUTH_SESSION_CACHE_SIZE", "10000"))
+    cache_ttl = float(os.getenv("AUTH_SESSION_CACHE_TTL", "0"))
+
+    if kind == "memory":
+        return MemorySessionStore(
+            ttl, int(os.getenv("AUTH_SESSION_MEMORY_MAX", "100000")))
+    if kind == "sql":
+        store = SQLSessionStore(db, ttl)
+    elif kind == "redis":
+        redis_url = os.getenv("AUTH_REDIS_URL")
+        if redis_url:
+            import redis
+            client = redis.Redis.from_url(redis_url)
+        else:
+            client = FakeRedis()
+        store = RedisSessionStore(client, ttl)
+    else:
+        raise ValueError("Unknown session store: {}".format(kind))
+
+    if cache_ttl <= 0:
+        return store
+    return CachedSessionStore(store, cache_size, cache_ttl)
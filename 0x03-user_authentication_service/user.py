@@ -3,7 +3,7 @@
 User model
 """
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String
 
 
 Base = declarative_base()
@@ -20,3 +20,27 @@ class User(Base):
     hashed_password = Column(String(250), nullable=False)
     session_id = Column(String(250), nullable=True)
     reset_token = Column(String(250), nullable=True)
+
+    # Every lookup of find_user_by goes through one of these. Tokens
+    # are only indexed where set, on backends with partial indexes.
+    # session_id is not indexed: sessions are looked up in the sessions
+    # table, by its primary key or its user_id index
+    __table_args__ = (
+        Index("ix_users_email", email, unique=True),
+        Index("ix_users_reset_token", reset_token, unique=True,
+              sqlite_where=reset_token.isnot(None),
+              postgresql_where=reset_token.isnot(None)),
+    )
+
+
+class UserSession(Base):
+    """
+    Session model, a user may hold several sessions
+    """
+
+    __tablename__ = "sessions"
+    id = Column(String(250), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False,
+                     index=True)
+    # Unix time, None for a session that never expires
+    expires_at = Column(Float, nullable=True, index=True)